@@ -0,0 +1,163 @@
+"""asyncio interface to AutoLoad"""
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+from seed.utils.cache import get_cache
+
+from .autoload import (
+    ACQUIRE_LOCK,
+    AutoLoad,
+    poll_delays,
+    task_notifier,
+    task_status,
+    task_timed_out,
+    TASK_TIMEOUT
+)
+from .checkpoint import Checkpoint
+from .metrics import Metrics
+
+
+class AsyncAutoLoad:
+    """Coroutine counterpart of AutoLoad for use from an asyncio event loop.
+
+    Database and storage work runs on a thread pool of at most max_workers
+    threads while waiting for celery tasks happens on the event loop, so a
+    single loop can drive many imports at once without a thread each.
+    Keyword arguments are passed on to AutoLoad.
+    """
+    def __init__(self, user, org, max_workers=8, **kwargs):
+        self.loader = AutoLoad(user, org, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def close(self):
+        self.executor.shutdown()
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(_in_thread, func, *args, **kwargs))
+
+    async def upload(self, filename, data, dataset, cycle, **kwargs):
+        return await self._call(self.loader.upload, filename, data, dataset, cycle, **kwargs)
+
+    async def create_green_assessment_property(self, assessment_data, address, postal_code):
+        return await self._call(
+            self.loader.create_green_assessment_property, assessment_data, address, postal_code)
+
+    async def create_green_assessment_properties(self, records):
+        return await self._call(self.loader.create_green_assessment_properties, records)
+
+    async def wait_for_task(self, key, timeout=None):
+        """Same as AutoLoad.wait_for_task without blocking the event loop"""
+        if timeout is None:
+            timeout = self.loader.timeout if self.loader.timeout is not None else TASK_TIMEOUT
+        deadline = time.time() + timeout
+
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        def wake_up():
+            loop.call_soon_threadsafe(wake.set)
+
+        task_notifier.subscribe(wake_up)
+        try:
+            for delay in poll_delays():
+                wake.clear()
+                resp = task_status(key, await self._call(get_cache, key))
+                if resp is not None:
+                    return resp
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return task_timed_out(key)
+
+                try:
+                    await asyncio.wait_for(wake.wait(), min(delay, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            task_notifier.unsubscribe(wake_up)
+
+    async def autoload_file(self, file_id, col_mappings):
+        checkpoint = Checkpoint(file_id, col_mappings=col_mappings)
+        return await self._drive(file_id, col_mappings, checkpoint)
+
+    async def resume(self, file_id, col_mappings=None):
+        checkpoint = await self._call(Checkpoint.load, file_id)
+        col_mappings = col_mappings or checkpoint.col_mappings
+        if col_mappings is None and not checkpoint.is_done('save_column_mappings'):
+            return {'status': 'error',
+                    'message': 'column mappings are required to resume',
+                    'import_file_id': file_id}
+        return await self._drive(file_id, col_mappings, checkpoint)
+
+    async def _drive(self, file_id, col_mappings, checkpoint):
+        metrics = Metrics('autoload_file')
+        steps = self.loader._autoload_steps(file_id, col_mappings, metrics, checkpoint)
+        resp = None
+        # a lock acquired for the pipeline that it hasn't been told about yet
+        held = None
+        future = None
+        try:
+            while True:
+                future = self.executor.submit(_in_thread, _step, steps, resp, metrics)
+                (done, value) = await asyncio.wrap_future(future)
+                held = None
+                if done:
+                    return value
+
+                (action, arg) = value
+                with metrics.waiting():
+                    if action == ACQUIRE_LOCK:
+                        resp = await _acquire(arg)
+                        held = arg
+                    else:
+                        resp = await self.wait_for_task(arg, checkpoint.timeout)
+        except asyncio.CancelledError:
+            self._abandon(steps, future, held)
+            raise
+
+    def _abandon(self, steps, future, held):
+        """Clean up after a cancelled _drive: once the step that was last
+        submitted is out of the way, close the pipeline so that its finally
+        blocks release what it holds. If that step never ran, the pipeline
+        doesn't know about the lock acquired for it either."""
+        def close(future):
+            if future.cancelled() and held is not None:
+                held.release()
+            self.executor.submit(steps.close)
+
+        if future is None:
+            return
+        future.add_done_callback(close)
+
+
+async def _acquire(lock):
+    """Acquire a threading lock without blocking the event loop. Polling
+    rather than waiting for the lock on another thread means a cancelled
+    caller can't end up holding it."""
+    for delay in poll_delays():
+        if lock.acquire(blocking=False):
+            return True
+        await asyncio.sleep(delay)
+
+
+def _in_thread(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # don't hold on to connections the database may have closed
+        connection.close_if_unusable_or_obsolete()
+
+
+def _step(steps, value, metrics):
+    """Advance an AutoLoad pipeline, returning (True, response) once it has
+    finished and (False, (action, argument)) while it is waiting"""
+    try:
+        with metrics.counting():
+            return False, steps.send(value)
+    except StopIteration as stop:
+        return True, stop.value
@@ -1,9 +1,17 @@
-import os
-import time, calendar
+import csv
+import io
+import time
 import json
+import hashlib
+import tempfile
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
 
-from django.core.files.storage import default_storage, FileSystemStorage
-from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connection, transaction
 
 import seed.data_importer.tasks as tasks
 from helix.models import HELIXGreenAssessmentProperty, HelixMeasurement
@@ -24,69 +32,504 @@ from seed.models.auditlog import (
 from seed.data_importer.models import ImportFile
 from seed.utils.cache import get_cache
 
+from .checkpoint import Checkpoint
+from .dedup import find_file, is_loaded, mark_loaded, remember_upload
+from .delta import (
+    commit_state,
+    hash_rows,
+    identity_key,
+    load_state,
+    remember_state,
+    save_state
+)
+from .duplicates import LATEST_STATE, DuplicateResolver
+from .index import ViewIndex, in_or_null
+from .lookups import LookupCache
+from .mappings import mapping_cache
+from .metrics import MemorySink, Metrics
+from .preflight import EXCEL_EXTENSIONS, SAMPLE_BYTES, check_mappings, profile
+from .storage import DjangoStorage, default_backend, file_key
+
+try:
+    from celery.signals import task_postrun
+except ImportError:
+    task_postrun = None
+
+# Polling schedule used by wait_for_task when no completion signal arrives,
+# which is always the case for tasks run by celery workers, in seconds. The delay starts small so that tasks which finish quickly
+# (or run eagerly) are picked up almost immediately and backs off towards
+# POLL_MAX for long running tasks.
+POLL_INITIAL = 0.01
+POLL_MAX = 1.0
+POLL_FACTOR = 2
+
+# Maximum number of seconds to wait for a single celery stage. Unless a
+# timeout is given, large files get TASK_SECONDS_PER_ROW for each of the rows
+# estimated by the preflight check if that is longer.
+TASK_TIMEOUT = 3600
+TASK_SECONDS_PER_ROW = 0.01
+
+# What the autoload_file pipeline is waiting for, see AutoLoad._autoload_steps
+WAIT_FOR_TASK = 'task'
+ACQUIRE_LOCK = 'lock'
+
+# Number of green assessment records written per transaction
+BATCH_SIZE = 1000
+
+# Error given for green assessment records whose address matches no view
+NO_VIEW = 'no property view'
+
+# Number of bytes read and written at a time when uploading files
+CHUNK_SIZE = 1024 * 1024
+
+# Uploads that are hashed before storing are kept in memory up to this size
+SPOOL_SIZE = 16 * CHUNK_SIZE
+
+
+class TaskNotifier:
+    """Wakes up anything waiting on a celery task whenever a task finishes
+    in this process, which only happens when celery runs tasks eagerly.
+    Tasks run by celery workers finish in another process and nothing
+    relays that here, so waiting on them relies on polling alone.
+    notify() can be called by any other event source."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = set()
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._listeners.add(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._listeners.discard(callback)
+
+    def notify(self, *args, **kwargs):
+        with self._lock:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback()
+
+
+task_notifier = TaskNotifier()
+if task_postrun is not None:
+    task_postrun.connect(task_notifier.notify, weak=False)
+
+
+def poll_delays():
+    """Yields the delays between checks of a task's progress: exponential
+    backoff from POLL_INITIAL up to POLL_MAX with jitter"""
+    delay = POLL_INITIAL
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * POLL_FACTOR, POLL_MAX)
+
+
+def task_status(key, prog):
+    """The result of waiting on a task given its progress data, or None if
+    the task is still running"""
+    prog = prog or {}
+    if prog.get('status') == 'error':
+        return {'status': 'error',
+                'message': prog.get('message', 'task failed'),
+                'progress_key': key}
+    if int(prog.get('progress', 0)) >= 100:
+        return {'status': 'success', 'progress_key': key}
+    return None
+
+
+def task_timeout(rows):
+    """Seconds to wait for a celery stage of a file with the given number
+    of rows"""
+    return max(TASK_TIMEOUT, rows * TASK_SECONDS_PER_ROW)
+
+
+def task_timed_out(key):
+    return {'status': 'error',
+            'message': 'timed out waiting for task',
+            'progress_key': key}
+
+
 class AutoLoad:
-    def __init__(self, user, org):
+    def __init__(self, user, org, timeout=None, metrics_sink=None, storage=None):
         self.org = org
         self.user = user
+        self.timeout = timeout
+
+        # where uploads are stored, see storage.py. Defaults to a backend for
+        # the default django storage
+        self.storage = storage if storage is not None else default_backend()
+        self.view_index = None
+        self.duplicate_resolver = None
+        self.lookups = None
+
+        # called with (method name, metrics dict) after each autoload_file or
+        # green assessment batch
+        self.metrics_sink = metrics_sink if metrics_sink is not None else MemorySink()
+
+        # creating columns and matching are run for one file at a time
+        self._columns_lock = threading.Lock()
+        self._match_locks = {}
+        self._match_locks_lock = threading.Lock()
 
     def autoload_file(self, file_id, col_mappings):
+        checkpoint = Checkpoint(file_id, col_mappings=col_mappings)
+        return self._drive(file_id, col_mappings, checkpoint)
+
+    """ Continue loading a file whose autoload_file was interrupted, e.g.
+        because the worker died. Stages the file already completed are
+        skipped and if a celery task was running for the current stage it is
+        waited on rather than started again. col_mappings defaults to the
+        mappings the file was first loaded with."""
+    def resume(self, file_id, col_mappings=None):
+        checkpoint = Checkpoint.load(file_id)
+        col_mappings = col_mappings or checkpoint.col_mappings
+        if col_mappings is None and not checkpoint.is_done('save_column_mappings'):
+            return {'status': 'error',
+                    'message': 'column mappings are required to resume',
+                    'import_file_id': file_id}
+        return self._drive(file_id, col_mappings, checkpoint)
+
+    def _drive(self, file_id, col_mappings, checkpoint):
+        metrics = Metrics('autoload_file')
+        steps = self._autoload_steps(file_id, col_mappings, metrics, checkpoint)
+        resp = None
+        while True:
+            try:
+                with metrics.counting():
+                    (action, arg) = steps.send(resp)
+            except StopIteration as stop:
+                return stop.value
+            with metrics.waiting():
+                if action == ACQUIRE_LOCK:
+                    resp = arg.acquire()
+                else:
+                    resp = self.wait_for_task(arg, checkpoint.timeout)
+
+    """ The autoload_file pipeline as a generator so that it can be driven
+        by blocking and asyncio code alike. Whenever it has to wait it yields
+        either (WAIT_FOR_TASK, progress key), expecting to be sent the result
+        of wait_for_task, or (ACQUIRE_LOCK, lock), expecting the lock to have
+        been acquired when it is resumed. The response is returned through
+        StopIteration."""
+    def _autoload_steps(self, file_id, col_mappings, metrics, checkpoint):
+        # files uploaded with dedup=True are only loaded once. Resuming a
+        # file past the column mappings may not know them, in which case
+        # there is nothing to check or record.
+        if col_mappings is not None and is_loaded(file_id, col_mappings):
+            return {'status': 'success', 'import_file_id': file_id, 'deduplicated': True}
+
+        with metrics.timed():
+            resp = yield from self._pipeline(file_id, col_mappings, metrics, checkpoint)
+        resp['metrics'] = self._emit_metrics(metrics)
+
+        if resp['status'] == 'success':
+            if col_mappings is not None:
+                mark_loaded(file_id, col_mappings)
+            commit_state(self.storage, file_id)
+        return resp
+
+    def _pipeline(self, file_id, col_mappings, metrics, checkpoint):
         # upload and save to Property state table
 #        file_id = self.upload('autoload.csv', data, dataset, cycle)
 
-        resp = self.save_raw_data(file_id)
-        if (resp['status'] == 'error'):
-            return resp
-        save_prog_key = resp['progress_key']
-        self.wait_for_task(save_prog_key)
+        # catch files that don't match the mappings before starting any task
+        if (not checkpoint.is_done('save_raw_data') and
+                checkpoint.in_flight('save_raw_data') is None):
+            with metrics.stage('preflight'):
+                resp = self.preflight(file_id, col_mappings)
+            if (resp['status'] == 'error'):
+                return resp
+            if resp['profile'] is not None and self.timeout is None:
+                checkpoint.timeout = task_timeout(resp['profile']['estimated_rows'])
+
+        with metrics.stage('save_raw_data'):
+            resp = yield from self._task_stage(
+                checkpoint, 'save_raw_data', self.save_raw_data)
+            if (resp['status'] == 'error'):
+                return resp
+        metrics.rows = ImportFile.objects.values_list('num_rows', flat=True).get(pk=file_id)
 
         # perform column mapping
-        self.save_column_mappings(file_id, col_mappings)
-        resp = self.perform_mapping(file_id)
-        if (resp['status'] == 'error'):
-            return resp
-        map_prog_key = resp['progress_key']
-
-        self.wait_for_task(map_prog_key)
-        self.mapping_done(file_id)
+        if not checkpoint.is_done('save_column_mappings'):
+            with metrics.stage('save_column_mappings'), self._columns_lock:
+                self.save_column_mappings(file_id, col_mappings)
+            checkpoint.complete('save_column_mappings')
+
+        with metrics.stage('map_data'):
+            resp = yield from self._task_stage(
+                checkpoint, 'map_data', self.perform_mapping)
+            if (resp['status'] == 'error'):
+                return resp
+
+        if not checkpoint.is_done('finish_mapping'):
+            with metrics.stage('finish_mapping'):
+                self.mapping_done(file_id)
+            checkpoint.complete('finish_mapping')
 
         # attempt to match with existing records
-        resp = self.start_system_matching(file_id)
-        if (resp['status'] == 'error'):
-            return resp
-        match_prog_key = resp['progress_key']
-        self.wait_for_task(match_prog_key)
+        if not checkpoint.is_done('match_buildings'):
+            with metrics.stage('match_buildings'):
+                match_lock = self._match_lock(file_id)
+                yield ACQUIRE_LOCK, match_lock
+                try:
+                    resp = yield from self._task_stage(
+                        checkpoint, 'match_buildings', self.start_system_matching)
+                    if (resp['status'] == 'error'):
+                        return resp
+                    if self.view_index is not None:
+                        self.view_index.update_from_file(file_id)
+                finally:
+                    match_lock.release()
 
         return {'status': 'success', 'import_file_id': file_id}
 
-    """ wait for a celery task to finish running"""
-    def wait_for_task(self, key):
-        prog = 0
-        while prog < 100:
-            prog = int(get_cache(key)['progress'])
-            
-            # Call to sleep is required otherwise this method will hang. It
-            # could be maybe to reduced less than 1 second.
-            time.sleep(1.0)
-
-    """Upload a file to the specified import record"""
-    def upload(self, filename, data, dataset, cycle):
-        if 'S3' in settings.DEFAULT_FILE_STORAGE:
-            path = 'data_imports/' + filename + '.'+ str(calendar.timegm(time.gmtime())/1000)
-            temp_file = default_storage.open(path, 'w')
-            temp_file.write(data)
-            temp_file.close()
-        else:        
-            path = settings.MEDIA_ROOT + "/uploads/" + filename
-            path = FileSystemStorage().get_available_name(path)
-
-            # verify the directory exists
-            if not os.path.exists(os.path.dirname(path)):
-                os.makedirs(os.path.dirname(path))
-
-            # save the file
-            with open(path, 'wb+') as temp_file:
-                temp_file.write(data)
+    """ Run one of the celery stages of the pipeline unless the checkpoint
+        shows it has already completed. A task that was started earlier and
+        hasn't failed is waited on instead of being started again."""
+    def _task_stage(self, checkpoint, stage, start_task):
+        if checkpoint.is_done(stage):
+            return {'status': 'success'}
+
+        progress_key = checkpoint.in_flight(stage)
+        if progress_key is not None:
+            prog = get_cache(progress_key)
+            if not prog or prog.get('status') == 'error':
+                progress_key = None
 
+        if progress_key is None:
+            resp = start_task(checkpoint.file_id)
+            if (resp['status'] == 'error'):
+                return resp
+            progress_key = resp['progress_key']
+            checkpoint.start(stage, progress_key)
+
+        resp = yield WAIT_FOR_TASK, progress_key
+        if (resp['status'] == 'error'):
+            checkpoint.fail(stage)
+        else:
+            checkpoint.complete(stage)
+        return resp
+
+    """ Check an uploaded csv file against col_mappings without starting
+        any celery task. Only the header and the first rows are read, to make
+        sure every from_field is a column of the file (exactly, a stray space
+        is enough for a column not to be mapped) and to estimate the number
+        of rows and the type of each column.
+
+        Returns {'status': 'success', 'profile': ...} with the profile
+        described in preflight.profile (None for excel files, which aren't
+        checked) or an error listing the problems found."""
+    def preflight(self, file_id, col_mappings):
+        import_file = ImportFile.objects.get(pk=file_id)
+        if import_file.uploaded_filename.lower().endswith(EXCEL_EXTENSIONS):
+            return {'status': 'success', 'profile': None}
+
+        name = import_file.file.name
+        # files not uploaded with this loader's backend, e.g. uploaded
+        # through SEED, are read from the import file's storage like SEED's
+        # tasks do
+        storage = self.storage
+        if not storage.exists(name):
+            storage = DjangoStorage(import_file.file.storage)
+        # only the sample is fetched, however large the file
+        f = storage.open_read(name, SAMPLE_BYTES)
+        try:
+            file_profile = profile(f, storage.size(name))
+        finally:
+            f.close()
+
+        problems = check_mappings(file_profile['columns'], col_mappings or [])
+        if problems:
+            return {'status': 'error',
+                    'message': '; '.join(problems),
+                    'problems': problems,
+                    'import_file_id': file_id}
+        return {'status': 'success', 'profile': file_profile}
+
+    def _emit_metrics(self, metrics):
+        result = metrics.as_dict()
+        self.metrics_sink(metrics.name, result)
+        return result
+
+    """ Run autoload_file for several files at once. jobs is a list of
+        (file_id, col_mappings) tuples.
+
+        Up to max_concurrency files are in the pipeline at the same time, so
+        one file's save_raw_data can run on the celery workers while another
+        file is mapping. Matching only runs for one file per cycle at a time.
+
+        Returns the autoload_file response of each job, in order, with the
+        number of seconds the job took under 'elapsed'."""
+    def autoload_files(self, jobs, max_concurrency=4):
+        def run(job):
+            start = time.time()
+            try:
+                resp = self.autoload_file(*job)
+            except Exception as e:
+                resp = {'status': 'error', 'message': str(e), 'import_file_id': job[0]}
+            finally:
+                # each worker thread has its own database connection
+                connection.close()
+            resp['elapsed'] = time.time() - start
+            return resp
+
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        try:
+            return list(executor.map(run, jobs))
+        finally:
+            executor.shutdown()
+
+    def _match_lock(self, file_id):
+        cycle_id = ImportFile.objects.values_list('cycle_id', flat=True).get(pk=file_id)
+        with self._match_locks_lock:
+            return self._match_locks.setdefault(cycle_id, threading.Lock())
+
+    """ wait for a celery task to finish running. Returns as soon as a task
+        finishing in this process signals completion, otherwise re-checks the
+        progress cache with exponential backoff and jitter. Tasks run by
+        celery workers are only ever noticed by polling, at most POLL_MAX
+        seconds after they finish. Gives up with an
+        error once timeout seconds (self.timeout, or TASK_TIMEOUT, by
+        default) have passed."""
+    def wait_for_task(self, key, timeout=None):
+        if timeout is None:
+            timeout = self.timeout if self.timeout is not None else TASK_TIMEOUT
+        deadline = time.time() + timeout
+
+        wake = threading.Event()
+        wake_up = wake.set
+        task_notifier.subscribe(wake_up)
+        try:
+            for delay in poll_delays():
+                wake.clear()
+                resp = task_status(key, get_cache(key))
+                if resp is not None:
+                    return resp
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return task_timed_out(key)
+
+                wake.wait(min(delay, remaining))
+        finally:
+            task_notifier.unsubscribe(wake_up)
+
+    """Upload a file to the specified import record.
+
+       data can be a string, bytes, a file-like object or an iterable of
+       string or byte chunks. It is written out CHUNK_SIZE bytes at a time
+       to self.storage, as a multipart upload when storing on S3, so the file
+       never needs to fit in memory. If given, progress is called with the
+       total number of bytes written after each chunk.
+
+       With dedup=True the sha256 of the content is computed first and, if
+       the same content was already loaded into this cycle with the same
+       col_mappings, the existing import file id is returned without storing
+       anything. autoload_file then returns immediately for that file.
+       Deduplicated content is stored under its digest and isn't written
+       again if it is already there."""
+    def upload(self, filename, data, dataset, cycle, progress=None, dedup=False,
+               col_mappings=None):
+        if not dedup:
+            path = self._store(file_key(filename), data, progress)
+            return self._create_import_file(filename, path, dataset, cycle)
+
+        col_mappings = col_mappings or []
+        (digest, content) = _hash_content(data)
+        try:
+            file_id = find_file(self.org.pk, _pk(cycle), col_mappings, digest)
+            if file_id is not None and ImportFile.objects.filter(pk=file_id).exists():
+                return file_id
+            path = self.storage.name(file_key(filename, digest))
+            if not self.storage.exists(path):
+                path = self._store(file_key(filename, digest), content, progress)
+        finally:
+            if content is not data:
+                content.close()
+
+        file_id = self._create_import_file(filename, path, dataset, cycle)
+        remember_upload(file_id, self.org.pk, _pk(cycle), col_mappings, digest)
+        return file_id
+
+    """ Upload only the rows of a csv file that are new or have changed
+        since the last file uploaded with upload_delta into the same dataset
+        and cycle. Rows are matched up by the values of the identity columns,
+        e.g. ['Address', 'Postal Code'], and compared by hash.
+
+        data is anything upload accepts. Returns the counts of 'new',
+        'changed' and 'unchanged' rows, the 'import_file_id' of the file
+        holding the new and changed rows (None if there are none) to pass
+        to autoload_file, and under 'deleted' the identity columns of the
+        rows of the last file that are missing from this one. Those are only
+        reported; SEED's records for them are left alone.
+
+        The hashes of this file are compared against by the next upload once
+        autoload_file has loaded it, or straight away if nothing changed."""
+    def upload_delta(self, filename, data, dataset, cycle, identity, progress=None):
+        identity = list(identity)
+        source = io.TextIOWrapper(tempfile.TemporaryFile(), encoding='utf-8-sig', newline='')
+        delta = io.TextIOWrapper(tempfile.TemporaryFile(), encoding='utf-8', newline='')
+        try:
+            for chunk in _chunks(data):
+                source.buffer.write(chunk)
+
+            source.seek(0)
+            reader = csv.reader(source)
+            header = next(reader, [])
+            missing = [column for column in identity if column not in header]
+            if missing:
+                return {'status': 'error',
+                        'message': 'identity columns not in file: %s' % ', '.join(missing)}
+            hashes = hash_rows(_csv_rows(reader), header, identity)
+            previous = load_state(self.storage, _pk(dataset), _pk(cycle), identity)
+
+            # read the file again for the rows that need to be loaded
+            resp = {'status': 'success', 'import_file_id': None,
+                    'new': 0, 'changed': 0, 'unchanged': 0}
+            source.seek(0)
+            reader = csv.reader(source)
+            writer = csv.writer(delta, lineterminator='\n')
+            writer.writerow(next(reader))
+            for row in _csv_rows(reader):
+                key = identity_key(header, row, identity)
+                if key not in previous:
+                    resp['new'] += 1
+                elif hashes[key] and hashes[key] == previous[key]:
+                    resp['unchanged'] += 1
+                    continue
+                else:
+                    resp['changed'] += 1
+                writer.writerow(row)
+            resp['deleted'] = [dict(zip(identity, json.loads(key)))
+                               for key in previous if key not in hashes]
+
+            if resp['new'] or resp['changed']:
+                delta.flush()
+                delta.buffer.seek(0)
+                path = self._store(file_key(filename), delta.buffer, progress)
+                resp['import_file_id'] = self._create_import_file(filename, path, dataset, cycle)
+                remember_state(self.storage, resp['import_file_id'],
+                               _pk(dataset), _pk(cycle), identity, hashes)
+            else:
+                save_state(self.storage, _pk(dataset), _pk(cycle), identity, hashes)
+            return resp
+        finally:
+            source.close()
+            delta.close()
+
+    def _store(self, key, data, progress):
+        def chunks():
+            written = 0
+            for chunk in _chunks(data):
+                yield chunk
+                written += len(chunk)
+                if progress is not None:
+                    progress(written)
+
+        return self.storage.write(key, chunks())
+
+    def _create_import_file(self, filename, path, dataset, cycle):
         f = ImportFile.objects.create(
                 import_record=dataset,
                 uploaded_filename=filename,
@@ -113,22 +556,28 @@ class AutoLoad:
          "to_field": "city",
          "to_table_name": "PropertyState",
         }],
+
+       Mappings that were already created for the organization, and haven't
+       changed since, are remembered and not sent to the server again.
     """
     def save_column_mappings(self, file_id, mappings):
         import_file = ImportFile.objects.get(pk=file_id)
         org = self.org
-        status = Column.create_mappings(mappings, org, self.user)
 
-        column_mappings = [
-            {'from_field': m['from_field'],
-             'to_field': m['to_field'],
-             'to_table_name': m['to_table_name']} for m in mappings]
+        column_mappings = mapping_cache.get(org.pk, mappings)
+        if column_mappings is None:
+            status = Column.create_mappings(mappings, org, self.user)
+            if not status:
+                return {'status': 'error'}
 
-        if status:
-            import_file.save_cached_mapped_columns(column_mappings)
-            return {'status': 'success'}
-        else:
-            return {'status': 'error'}
+            column_mappings = [
+                {'from_field': m['from_field'],
+                 'to_field': m['to_field'],
+                 'to_table_name': m['to_table_name']} for m in mappings]
+            mapping_cache.set(org.pk, mappings, column_mappings)
+
+        import_file.save_cached_mapped_columns(column_mappings)
+        return {'status': 'success'}
 
     """ Populate fields in PropertyState according to previously established
         Mapping"""
@@ -182,65 +631,365 @@ class AutoLoad:
             : Description:  array of related green assessment urls
             : required: false
             : Parameter: assessment
-            : Description:  id of associated green assessment
+            : Description:  associated green assessment, or its id, name or
+                            award body
     """
     def create_green_assessment_property(self, assessment_data, address, postal_code):
-        
+        return self.create_green_assessment_properties(
+            [(assessment_data, address, postal_code)])[0]
+
+    """ adds green_assessment_properties for a batch of records. records is an
+        iterable of (assessment_data, address, postal_code) tuples where
+        assessment_data is described in create_green_assessment_property.
+
+        Property views, prior assessments and their latest audit logs are
+        looked up with a few queries per batch of BATCH_SIZE records and audit
+        logs and urls are written with bulk_create.
+
+        Returns a list with an entry per record, in order: either
+        (data_log, green_property), None if the address matched more than
+        one property view and the duplicate resolver, if one is loaded,
+        couldn't choose between them, or ({'error': 'no property view'}, None)
+        if it matched none. Records without a view are skipped rather than
+        failing their batch."""
+    def create_green_assessment_properties(self, records):
+        records = [(dict(assessment_data), address, postal_code)
+                   for (assessment_data, address, postal_code) in records]
+
+        lookups = self.lookups or LookupCache(self.org)
+        for (assessment_data, _, _) in records:
+            assessment_data['assessment'] = lookups.assessment(assessment_data['assessment'])
+
+        results = []
+        with Metrics('create_green_assessment_properties') as metrics:
+            metrics.rows = len(records)
+            for start in range(0, len(records), BATCH_SIZE):
+                batch = records[start:start + BATCH_SIZE]
+                with transaction.atomic():
+                    results.extend(self._create_green_assessment_batch(batch, metrics))
+        self._emit_metrics(metrics)
+        return results
+
+    def _create_green_assessment_batch(self, records, metrics):
         # a green assessment property needs to be associated with a
         # property view. I'm using address as the key to find the correct view.
-        data_log = {'created': False, 'updated': False}
-        view = PropertyView.objects.filter(state__normalized_address=address, state__postal_code=postal_code, state__organization=self.org)
-        if len(view) > 1:
-            print(address1 + ' has duplicates')
-            return
-        else:
-            view = view.first()
-
-        # pull urls out of dict for use later
-        green_assessment_urls = assessment_data.pop('urls', [])
-
-        green_property = None
-        priorAssessments = HELIXGreenAssessmentProperty.objects.filter(
-                view=view,
-                assessment=assessment_data['assessment'])
-        if 'reference_id' in assessment_data:
-            priorAssessments = priorAssessments.filter(
-                reference_id=assessment_data['reference_id']
-            )
-            
-        if(not priorAssessments.exists()):
-            # If the property does not have an assessment in the database
-            # for the specifed assesment type createa new one.
-            assessment_data.update({'view': view})
-            green_property = HELIXGreenAssessmentProperty.objects.create(**assessment_data)
-            green_property.initialize_audit_logs(user=self.user)
-            green_property.save()
-            data_log['created'] = True
+        with metrics.stage('find_views'):
+            views = self._find_views(
+                set((address, postal_code) for (_, address, postal_code) in records))
+            if self.duplicate_resolver is not None:
+                views = self.duplicate_resolver.resolve_views(views)
+
+        with metrics.stage('prior_assessments'):
+            view_ids = set()
+            assessment_ids = set()
+            for (assessment_data, address, postal_code) in records:
+                view_ids.update(views[(address, postal_code)])
+                assessment_ids.add(_pk(assessment_data['assessment']))
+
+            # every prior assessment for the batch grouped by view and assessment,
+            # oldest first
+            prior_assessments = {}
+            for green_property in HELIXGreenAssessmentProperty.objects.filter(
+                    view_id__in=view_ids,
+                    assessment_id__in=assessment_ids).order_by('date', 'pk'):
+                key = (green_property.view_id, green_property.assessment_id)
+                prior_assessments.setdefault(key, []).append(green_property)
+
+            # the prior assessments that will be updated
+            prior_ids = set()
+            for (assessment_data, address, postal_code) in records:
+                view_ids = views[(address, postal_code)]
+                if len(view_ids) == 1:
+                    green_property = _latest_prior(
+                        prior_assessments, view_ids[0], assessment_data)
+                    if green_property is not None:
+                        prior_ids.add(green_property.pk)
+
+            # most recent audit log for each of them, the distinct on
+            # (greenassessmentproperty_id) reads a single row per property
+            latest_logs = {}
+            for audit_log in GreenAssessmentPropertyAuditLog.objects.filter(
+                    greenassessmentproperty_id__in=prior_ids
+                    ).exclude(record_type=AUDIT_USER_EXPORT).order_by(
+                        'greenassessmentproperty_id', '-created'
+                    ).distinct('greenassessmentproperty_id'):
+                latest_logs[audit_log.greenassessmentproperty_id] = audit_log
+
+        with metrics.stage('write'):
+            results = []
+            new_logs = []
+            new_urls = []  # (green property id, urls)
+            for (assessment_data, address, postal_code) in records:
+                view_ids = views[(address, postal_code)]
+                if len(view_ids) > 1:
+                    # see load_duplicate_resolver
+                    results.append(None)
+                    continue
+                if not view_ids:
+                    results.append(({'error': NO_VIEW}, None))
+                    continue
+                view_id = view_ids[0]
+
+                data_log = {'created': False, 'updated': False}
+
+                # pull urls out of dict for use later
+                green_assessment_urls = assessment_data.pop('urls', [])
+
+                green_property = _latest_prior(prior_assessments, view_id, assessment_data)
+                if green_property is None:
+                    # If the property does not have an assessment in the database
+                    # for the specifed assesment type createa new one.
+                    assessment_data.update({'view_id': view_id})
+                    green_property = HELIXGreenAssessmentProperty.objects.create(**assessment_data)
+                    audit_log = self._audit_log(
+                        green_property,
+                        name='Initial',
+                        description='Initial Creation',
+                        record_type=AUDIT_USER_CREATE)
+                    prior_assessments.setdefault(
+                        (view_id, green_property.assessment_id), []).append(green_property)
+                    new_logs.append(audit_log)
+                    latest_logs[green_property.pk] = audit_log
+                    data_log['created'] = True
+                else:
+                    # the most recent assessment is updated, unless nothing
+                    # changed in which case there is nothing to write or log
+                    changed_fields = _changed_fields(green_property, assessment_data)
+                    if changed_fields:
+                        old_audit_log = latest_logs.get(green_property.pk)
+                        if old_audit_log is not None and old_audit_log.pk is None:
+                            # the parent was logged earlier in this batch
+                            self._flush_audit_logs(new_logs)
+
+                        # update fields
+                        green_property.pk = None
+                        for (field, value) in assessment_data.items():
+                            setattr(green_property, field, value)
+                        green_property.save()
+
+                        # log changes
+                        audit_log = self._audit_log(
+                            green_property,
+                            name='Edit',
+                            description='Edited',
+                            record_type=AUDIT_USER_EDIT,
+                            changed_fields=json.dumps(changed_fields, default=str),
+                            ancestor=getattr(old_audit_log, 'ancestor', None),
+                            parent=old_audit_log)
+                        new_logs.append(audit_log)
+                        latest_logs[green_property.pk] = audit_log
+                        data_log['updated'] = True
+
+                # urls provided in assessment data are added to the url table
+                # for the whole batch at once
+                if green_assessment_urls:
+                    new_urls.append((green_property.pk, green_assessment_urls))
+
+                results.append((data_log, green_property))
+
+            self._flush_audit_logs(new_logs)
+            self._attach_urls(new_urls)
+        return results
+
+    """ attach urls to green assessment properties. urls is a list of
+        (green property id, list of urls). Urls are normalized (see
+        _normalize_url) and only those a property doesn't have yet are
+        added, reading the existing urls with one query and inserting the
+        rest with another. Returns the new GreenAssessmentURLs."""
+    def _attach_urls(self, urls):
+        property_ids = set(property_id for (property_id, _) in urls)
+        if not property_ids:
+            return []
+
+        seen = set(
+            (property_id, _normalize_url(url))
+            for (property_id, url) in GreenAssessmentURL.objects.filter(
+                property_assessment_id__in=property_ids
+            ).values_list('property_assessment_id', 'url'))
+
+        new_urls = []
+        for (property_id, property_urls) in urls:
+            for url in property_urls:
+                url = _normalize_url(url)
+                if url and (property_id, url) not in seen:
+                    seen.add((property_id, url))
+                    new_urls.append(GreenAssessmentURL(
+                        url=url,
+                        property_assessment_id=property_id))
+
+        # another loader may have added the same url in the meantime
+        return GreenAssessmentURL.objects.bulk_create(new_urls, ignore_conflicts=True)
+
+    """ Share a LookupCache between all green assessment batches loaded
+        within the block, e.g.
+
+            with loader.lookup_cache() as lookups:
+                for batch in batches:
+                    lookups.prime_measurements(...)
+                    loader.create_green_assessment_properties(batch)
+    """
+    @contextmanager
+    def lookup_cache(self, **kwargs):
+        previous = self.lookups
+        self.lookups = LookupCache(self.org, **kwargs).load()
+        try:
+            yield self.lookups
+        finally:
+            self.lookups = previous
+
+    """ Load every property view of the organization into memory so that
+        green assessments can be matched to views by address without a query
+        per record. The index is kept up to date by autoload_file."""
+    def load_view_index(self):
+        self.view_index = ViewIndex(self.org).load()
+        return self.view_index
+
+    """ Choose a view for addresses of the organization that match more
+        than one property view, rather than skipping their green assessments.
+        policies and cycle are described in DuplicateResolver; resolver.report()
+        lists every duplicated address and the view chosen for it."""
+    def load_duplicate_resolver(self, policies=(LATEST_STATE,), cycle=None):
+        self.duplicate_resolver = DuplicateResolver(self.org, policies, cycle).load()
+        return self.duplicate_resolver
+
+    """ find the property views of this organization for a set of
+        (normalized_address, postal_code) pairs, using the view index if it
+        is loaded or a single query otherwise. Returns a dict mapping each
+        pair to a list of view ids."""
+    def _find_views(self, keys):
+        if self.view_index is not None:
+            return dict((key, list(self.view_index.get(*key))) for key in keys)
+
+        views = dict((key, []) for key in keys)
+        rows = PropertyView.objects.filter(
+            in_or_null('state__normalized_address', (address for (address, _) in keys)),
+            in_or_null('state__postal_code', (postal_code for (_, postal_code) in keys)),
+            state__organization=self.org
+        ).values_list('state__normalized_address', 'state__postal_code', 'pk')
+        for (address, postal_code, view_id) in rows:
+            if (address, postal_code) in views:
+                views[(address, postal_code)].append(view_id)
+        return views
+
+    def _audit_log(self, green_property, **kwargs):
+        kwargs.update({'greenassessmentproperty': green_property,
+                       'user': self.user})
+        return GreenAssessmentPropertyAuditLog(**kwargs)
+
+    def _flush_audit_logs(self, audit_logs):
+        GreenAssessmentPropertyAuditLog.objects.bulk_create(audit_logs)
+        del audit_logs[:]
+
+
+def _pk(instance):
+    """Accept either a model instance or its primary key"""
+    return getattr(instance, 'pk', instance)
+
+
+def _latest_prior(prior_assessments, view_id, assessment_data):
+    """The most recent of the prior assessments for the view that
+    assessment_data would update, or None"""
+    candidates = prior_assessments.get(
+        (view_id, _pk(assessment_data['assessment'])), [])
+    if 'reference_id' in assessment_data:
+        candidates = [g for g in candidates
+                      if g.reference_id == assessment_data['reference_id']]
+    return candidates[-1] if candidates else None
+
+
+def _changed_fields(instance, data):
+    """The entries of data whose values differ from those of instance"""
+    changed = {}
+    for (field, value) in data.items():
+        try:
+            model_field = instance._meta.get_field(field)
+        except FieldDoesNotExist:
+            model_field = None
+
+        if model_field is not None and model_field.is_relation:
+            current = getattr(instance, model_field.attname)
+            value = _pk(value)
         else:
-            # find most recently created property and a corresponding audit log
-            green_property = priorAssessments.order_by('date').last()
-            old_audit_log = GreenAssessmentPropertyAuditLog.objects.filter(greenassessmentproperty=green_property).exclude(record_type=AUDIT_USER_EXPORT).order_by('created').last()
-
-            # update fields
-            green_property.pk = None
-            for (key, value) in assessment_data.items():
-                setattr(green_property, key, value)
-            green_property.save()
-
-            # log changes
-            green_property.log(
-                    changed_fields=assessment_data,
-                    ancestor=old_audit_log.ancestor,
-                    parent=old_audit_log,
-                    user=self.user)
-            data_log['updated'] = True
-
-        # add any urls provided in assessment data to the url table
-        for url in green_assessment_urls:
-            if (url != ''):
-                GreenAssessmentURL.objects.get_or_create(
-                     url=url,
-                     property_assessment=green_property)
-
-        return data_log, green_property
-
+            current = getattr(instance, field, None)
+            if model_field is not None and value is not None:
+                try:
+                    value = model_field.to_python(value)
+                except ValidationError:
+                    pass
+
+        if current != value:
+            changed[field] = data[field]
+    return changed
+
+
+def _normalize_url(url):
+    """Strip whitespace and the fragment, lowercase the scheme and host and
+    drop default ports so that trivially different urls compare equal"""
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    if not parts.scheme or not parts.hostname:
+        return url
+
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname
+    if ':' in netloc:
+        # ipv6
+        netloc = '[%s]' % netloc
+    if port is not None and (scheme, port) not in (('http', 80), ('https', 443)):
+        netloc = '%s:%s' % (netloc, port)
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ':' + parts.password
+        netloc = '%s@%s' % (userinfo, netloc)
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def _csv_rows(reader):
+    """The rows of a csv reader, without blank lines"""
+    for row in reader:
+        if any(value.strip() for value in row):
+            yield row
+
+
+def _chunks(data, chunk_size=CHUNK_SIZE):
+    """Yields data as byte strings of at most chunk_size bytes. data can be a
+    string, bytes, a file-like object or an iterable of chunks."""
+    if isinstance(data, (bytes, str)):
+        chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    elif hasattr(data, 'read'):
+        chunks = iter(lambda: data.read(chunk_size), data.read(0))
+    else:
+        chunks = data
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if chunk:
+            yield chunk
+
+
+def _hash_content(data):
+    """Returns the sha256 hex digest of data and something to read the same
+    content from again. Streams that can't be rewound are spooled to a
+    temporary file (in memory up to SPOOL_SIZE bytes) while hashing."""
+    digest = hashlib.sha256()
+    if isinstance(data, (bytes, str)) or (
+            hasattr(data, 'seekable') and data.seekable()):
+        start = None if isinstance(data, (bytes, str)) else data.tell()
+        for chunk in _chunks(data):
+            digest.update(chunk)
+        if start is not None:
+            data.seek(start)
+        return digest.hexdigest(), data
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for chunk in _chunks(data):
+        digest.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return digest.hexdigest(), spool
@@ -0,0 +1,288 @@
+"""Benchmarks for the autoload module
+
+The benchmarks generate synthetic assessor files and green assessments, load
+them with celery running eagerly and record throughput, latency percentiles,
+query counts and peak memory as JSON. They are skipped unless
+AUTOLOAD_BENCHMARK is set, e.g. from the root of the seed repository:
+
+    AUTOLOAD_BENCHMARK=1000,10000 AUTOLOAD_BENCHMARK_OUTPUT=bench.json \\
+        ./manage.py test autoload.benchmark
+
+Peak memory is traced in a second run of each size, since tracing skews
+the timings, unless AUTOLOAD_BENCHMARK_MEMORY=0.
+"""
+import datetime
+import json
+import os
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+import unittest
+from collections import Counter
+
+from celery import current_app
+from django.db import connection
+from django.test import TransactionTestCase
+from django.utils import timezone
+from seed.landing.models import SEEDUser as User
+from seed.lib.superperms.orgs.models import Organization, OrganizationUser
+from seed.models import Cycle
+from seed.models.certification import GreenAssessment
+from seed.data_importer.models import ImportRecord
+
+from .autoload import AutoLoad, BATCH_SIZE
+from .metrics import QueryBudgetMixin, QueryLog
+
+SIZES = (1000, 10000, 100000, 1000000)
+
+COL_MAPPINGS = [
+    {"from_field": "Address",
+     "to_field": "address_line_1",
+     "to_table_name": "PropertyState"},
+    {"from_field": "City",
+     "to_field": "city",
+     "to_table_name": "PropertyState"},
+    {"from_field": "Postal Code",
+     "to_field": "postal_code",
+     "to_table_name": "PropertyState"},
+    {"from_field": "Score",
+     "to_field": "energy_score",
+     "to_table_name": "PropertyState"}]
+
+STREETS = ('maple', 'oak', 'pine', 'elm', 'cedar', 'birch', 'main', 'church')
+
+
+def _address(i):
+    # already in normalized form so that assessments can refer to it directly
+    return '%d %s st' % (i // len(STREETS) + 1, STREETS[i % len(STREETS)])
+
+
+def _postal_code(i):
+    return '%05d' % (1000 + i % 500)
+
+
+def _row_indices(rows, duplicate_rate, seed):
+    """Yields the index of the address used by each row. A duplicate_rate
+    fraction of the rows reuse an address from an earlier row."""
+    rng = random.Random(seed)
+    unique = []
+    for i in range(rows):
+        if unique and rng.random() < duplicate_rate:
+            yield rng.choice(unique)
+        else:
+            unique.append(i)
+            yield i
+
+
+def generate_assessor_csv(rows, duplicate_rate=0.0, seed=0):
+    """Yields the lines of an assessor csv with the given number of rows"""
+    rng = random.Random(seed + 1)
+    yield 'Address,City,Postal Code,Score\n'
+    for j in _row_indices(rows, duplicate_rate, seed):
+        yield '%s,Burlington,%s,%d\n' % (_address(j), _postal_code(j), rng.randint(1, 10))
+
+
+def generate_green_assessments(rows, assessment, duplicate_rate=0.0,
+                               urls_per_record=1, seed=0):
+    """Yields (assessment_data, address, postal_code) records for the
+    addresses written by generate_assessor_csv with the same arguments"""
+    rng = random.Random(seed + 1)
+    start = datetime.date(2017, 1, 1)
+    for (i, j) in enumerate(_row_indices(rows, duplicate_rate, seed)):
+        assessment_data = {
+            'source': 'benchmark',
+            'metric': rng.randint(1, 10),
+            'date': start + datetime.timedelta(days=rng.randrange(365)),
+            'assessment': assessment,
+            'urls': ['https://example.com/report/%d/%d' % (i, n)
+                     for n in range(urls_per_record)]}
+        yield assessment_data, _address(j), _postal_code(j)
+
+
+def _split_csv(lines, rows_per_file):
+    """Split the lines of a csv into files of rows_per_file rows, each
+    starting with the header. Each file has to be read before the next."""
+    header = next(lines)
+    for first in lines:
+        yield itertools.chain([header, first], itertools.islice(lines, rows_per_file - 1))
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    if not values:
+        return dict(('p%d' % p, None) for p in points)
+    return dict(('p%d' % p, values[min(len(values) - 1, len(values) * p // 100)])
+                for p in points)
+
+
+def _batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_benchmark(loader, dataset, cycle, assessment, rows, duplicate_rate=0.0,
+                  urls_per_record=1, seed=0, check_batch=None, files=10,
+                  trace_memory=False):
+    """Load rows synthetic properties, split over the given number of
+    files, and green assessments for them and return the measurements as a
+    dict. check_batch, if given, is called with the QueryLog and the number
+    of records of each green assessment batch.
+
+    With trace_memory the peak memory allocated by python is traced as
+    well, under 'peak_memory'. Tracing slows down every allocation, so the
+    timings of such a run aren't comparable with those of a run without."""
+    result = {'rows': rows,
+              'duplicate_rate': duplicate_rate,
+              'urls_per_record': urls_per_record}
+
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        latencies = []
+        responses = []
+        start = time.time()
+        for lines in _split_csv(generate_assessor_csv(rows, duplicate_rate, seed),
+                                -(-rows // files)):
+            file_start = time.time()
+            file_id = loader.upload('benchmark.csv', lines, dataset, cycle)
+            responses.append(loader.autoload_file(file_id, COL_MAPPINGS))
+            latencies.append(time.time() - file_start)
+        elapsed = time.time() - start
+        failed = [resp for resp in responses if resp['status'] != 'success']
+        result['autoload_file'] = {
+            'status': failed[0]['status'] if failed else 'success',
+            'files': len(responses),
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed,
+            'file_seconds': percentiles(latencies),
+            'metrics': [resp.get('metrics') for resp in responses]}
+
+        latencies = []
+        queries = Counter()
+        start = time.time()
+        records = generate_green_assessments(
+            rows, assessment, duplicate_rate, urls_per_record, seed)
+        for batch in _batches(records, BATCH_SIZE):
+            # a log per batch so that the SQL of a large run isn't kept
+            log = QueryLog()
+            batch_start = time.time()
+            with connection.execute_wrapper(log):
+                loader.create_green_assessment_properties(batch)
+            latencies.append(time.time() - batch_start)
+            queries.update(log.breakdown())
+            if check_batch is not None:
+                check_batch(log, len(batch))
+        elapsed = time.time() - start
+        total = sum(queries.values())
+        result['green_assessments'] = {
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed,
+            'queries': total,
+            'queries_per_row': total / float(rows),
+            'queries_by_model': dict(
+                ('%s %s' % (statement, model or '-'), count)
+                for ((model, statement), count) in queries.items()),
+            'batch_seconds': percentiles(latencies)}
+
+        if trace_memory:
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return result
+
+
+@unittest.skipUnless(os.environ.get('AUTOLOAD_BENCHMARK'), 'AUTOLOAD_BENCHMARK is not set')
+class AutoloadBenchmark(QueryBudgetMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.task_always_eager = current_app.conf.task_always_eager
+        current_app.conf.task_always_eager = True
+
+    def tearDown(self):
+        current_app.conf.task_always_eager = self.task_always_eager
+
+    # every run gets its own organization so that runs don't match each
+    # other's properties
+    def create_fixtures(self, name):
+        user = User.objects.create(username='%s@demo.com' % name)
+        org = Organization.objects.create(name=name)
+        OrganizationUser.objects.create(user=user, organization=org)
+
+        cycle = Cycle.objects.create(
+            organization=org,
+            user=user,
+            name=name,
+            start=timezone.now(),
+            end=timezone.now())
+
+        dataset = ImportRecord.objects.create(
+                name=name,
+                app='seed',
+                start_time=timezone.now(),
+                created_at=timezone.now(),
+                last_modified_by=user,
+                super_organization=org,
+                owner=user)
+
+        assessment = GreenAssessment.objects.create(
+                name='Home Energy Score',
+                award_body='Department of Energy',
+                recognition_type='SCR',
+                description='Developed by DOE...',
+                is_numeric_score=True,
+                is_integer_score=True,
+                validity_duration=datetime.timedelta(days=365),
+                organization=org)
+
+        return AutoLoad(user, org), dataset, cycle, assessment
+
+    def test_benchmark(self):
+        sizes = os.environ['AUTOLOAD_BENCHMARK']
+        sizes = SIZES if sizes == 'all' else [int(s) for s in sizes.split(',')]
+        duplicate_rate = float(os.environ.get('AUTOLOAD_BENCHMARK_DUPLICATES', 0))
+        urls_per_record = int(os.environ.get('AUTOLOAD_BENCHMARK_URLS', 1))
+        files = int(os.environ.get('AUTOLOAD_BENCHMARK_FILES', 10))
+        memory = os.environ.get('AUTOLOAD_BENCHMARK_MEMORY', '1') != '0'
+
+        # "per_batch,per_record" query budget for green assessment batches
+        check_batch = None
+        budget = os.environ.get('AUTOLOAD_BENCHMARK_QUERY_BUDGET')
+        if budget:
+            (per_batch, per_record) = [int(b) for b in budget.split(',')]
+
+            def check_batch(log, records):
+                self.assertWithinQueryBudget(log, per_batch, per_record, records)
+
+        results = []
+        for rows in sizes:
+            (loader, dataset, cycle, assessment) = self.create_fixtures('benchmark-%d' % rows)
+            results.append(run_benchmark(
+                loader, dataset, cycle, assessment, rows,
+                duplicate_rate, urls_per_record, check_batch=check_batch, files=files))
+            self.assertEqual(results[-1]['autoload_file']['status'], 'success')
+
+            # peak memory is measured by a second, untimed run into fixtures
+            # of its own
+            if memory:
+                (loader, dataset, cycle, assessment) = self.create_fixtures(
+                    'benchmark-%d-memory' % rows)
+                results[-1]['peak_memory'] = run_benchmark(
+                    loader, dataset, cycle, assessment, rows, duplicate_rate,
+                    urls_per_record, files=files, trace_memory=True)['peak_memory']
+
+        output = json.dumps(results, indent=2, default=str)
+        path = os.environ.get('AUTOLOAD_BENCHMARK_OUTPUT')
+        if path:
+            with open(path, 'w') as f:
+                f.write(output)
+        else:
+            sys.stderr.write(output + '\n')
@@ -0,0 +1,95 @@
+"""Progress of import files through the autoload_file pipeline"""
+from django.core.cache import cache
+from seed.data_importer.models import ImportFile
+
+# Seconds a checkpoint is kept after it last changed. Checkpoints of files
+# that made it through the pipeline are deleted straight away.
+CHECKPOINT_TIMEOUT = 7 * 24 * 3600
+
+# pipeline stages, in order
+STAGES = (
+    'save_raw_data',
+    'save_column_mappings',
+    'map_data',
+    'finish_mapping',
+    'match_buildings',
+)
+
+
+def _key(file_id):
+    return 'autoload:checkpoint:%s' % file_id
+
+
+class Checkpoint:
+    """Records the last stage an import file completed and the celery
+    progress key of the stage that is running, so that an interrupted
+    pipeline can pick up where it left off, along with the timeout chosen
+    for the file's tasks (None for the default). Checkpoints are kept in the
+    django cache next to the progress data of the tasks themselves."""
+    def __init__(self, file_id, completed=None, running=None, progress_key=None,
+                 col_mappings=None, timeout=None):
+        self.file_id = file_id
+        self.completed = completed
+        self.running = running
+        self.progress_key = progress_key
+        self.col_mappings = col_mappings
+        self.timeout = timeout
+
+    @classmethod
+    def load(cls, file_id):
+        """The saved checkpoint of a file. Without one, the stage is taken
+        from the import file's flags."""
+        data = cache.get(_key(file_id))
+        if data is not None:
+            return cls(file_id, **data)
+
+        import_file = ImportFile.objects.get(pk=file_id)
+        if import_file.matching_done:
+            completed = 'match_buildings'
+        elif import_file.mapping_done:
+            completed = 'finish_mapping'
+        elif import_file.raw_save_done:
+            completed = 'save_raw_data'
+        else:
+            completed = None
+        return cls(file_id, completed=completed)
+
+    def save(self):
+        cache.set(_key(self.file_id), {
+            'completed': self.completed,
+            'running': self.running,
+            'progress_key': self.progress_key,
+            'col_mappings': self.col_mappings,
+            'timeout': self.timeout}, CHECKPOINT_TIMEOUT)
+
+    def is_done(self, stage):
+        return (self.completed is not None and
+                STAGES.index(stage) <= STAGES.index(self.completed))
+
+    def in_flight(self, stage):
+        """Progress key of the task started for stage, if any"""
+        if self.running == stage:
+            return self.progress_key
+        return None
+
+    def start(self, stage, progress_key=None):
+        self.running = stage
+        self.progress_key = progress_key
+        self.save()
+
+    def complete(self, stage):
+        self.completed = stage
+        self.running = None
+        self.progress_key = None
+        if stage == STAGES[-1]:
+            # the import file's flags say as much from now on
+            cache.delete(_key(self.file_id))
+        else:
+            self.save()
+
+    def fail(self, stage):
+        """Forget the task started for stage so that it is started again"""
+        if self.running == stage:
+            self.running = None
+            self.progress_key = None
+            self.save()
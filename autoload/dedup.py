@@ -0,0 +1,56 @@
+"""Bookkeeping for skipping files that have already been loaded
+
+Uploads made with dedup=True are identified by the sha256 of their content
+together with the organization, cycle and column mappings they are loaded
+with. Once autoload_file has loaded such a file, uploading the same content
+again returns the existing import file and autoload_file returns straight
+away.
+"""
+from django.core.cache import cache
+
+from .checkpoint import CHECKPOINT_TIMEOUT
+from .mappings import mapping_hash
+
+# Seconds an upload waits to be loaded before it is forgotten. Uploads that
+# are never loaded, e.g. because the preflight check failed, would otherwise
+# be kept forever. Files can be resumed for as long as their checkpoint is.
+PENDING_TIMEOUT = CHECKPOINT_TIMEOUT
+
+
+def _content_key(org_id, cycle_id, mappings, digest):
+    return 'autoload:content:%s:%s:%s:%s' % (
+        org_id, cycle_id, mapping_hash(mappings), digest)
+
+
+def _pending_key(file_id):
+    return 'autoload:pending:%s' % file_id
+
+
+def _loaded_key(file_id, mappings):
+    return 'autoload:loaded:%s:%s' % (file_id, mapping_hash(mappings))
+
+
+def find_file(org_id, cycle_id, mappings, digest):
+    """Id of the import file already loaded with the same content, or None"""
+    return cache.get(_content_key(org_id, cycle_id, mappings, digest))
+
+
+def remember_upload(file_id, org_id, cycle_id, mappings, digest):
+    """Record the content of a new upload until it has been loaded"""
+    cache.set(_pending_key(file_id),
+              _content_key(org_id, cycle_id, mappings, digest), PENDING_TIMEOUT)
+
+
+def is_loaded(file_id, mappings):
+    return bool(cache.get(_loaded_key(file_id, mappings)))
+
+
+def mark_loaded(file_id, mappings):
+    """Called once autoload_file has loaded the file. Only files uploaded
+    with dedup=True are remembered."""
+    content_key = cache.get(_pending_key(file_id))
+    if content_key is None:
+        return
+    cache.set(content_key, file_id, None)
+    cache.set(_loaded_key(file_id, mappings), True, None)
+    cache.delete(_pending_key(file_id))
@@ -0,0 +1,90 @@
+"""Bookkeeping for loading only the rows that changed since the last import
+
+Each row of a file uploaded with AutoLoad.upload_delta is identified by the
+values of its identity columns and hashed. The hashes of the last file
+loaded into a dataset and cycle are kept as JSON in the upload storage, so
+the next file only needs to carry rows that are new or whose hash changed.
+The hashes of a new file are kept aside until autoload_file has loaded it.
+"""
+import hashlib
+import json
+
+STATE_PREFIX = 'autoload_state'
+
+
+def state_key(dataset_id, cycle_id):
+    return '%s/%s/%s.json' % (STATE_PREFIX, dataset_id, cycle_id)
+
+
+def _pending_key(file_id):
+    return '%s/pending/%s.json' % (STATE_PREFIX, file_id)
+
+
+def row_digest(row):
+    return hashlib.blake2b(
+        json.dumps(row, ensure_ascii=False).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def identity_key(header, row, identity):
+    """The identity of a row as a string, for use as a JSON key"""
+    values = dict(zip(header, row))
+    return json.dumps([values.get(column, '') for column in identity], ensure_ascii=False)
+
+
+def hash_rows(rows, header, identity):
+    """Map the identity of each row to its digest. Identities shared by
+    several rows map to '', since their rows can't be told apart, and these
+    rows are always loaded."""
+    hashes = {}
+    for row in rows:
+        key = identity_key(header, row, identity)
+        hashes[key] = '' if key in hashes else row_digest(row)
+    return hashes
+
+
+def _read(storage, name):
+    f = storage.open_read(name)
+    try:
+        return json.loads(f.read().decode('utf-8'))
+    finally:
+        f.close()
+
+
+def _write(storage, key, data):
+    return storage.write(key, [json.dumps(data).encode('utf-8')])
+
+
+def load_state(storage, dataset_id, cycle_id, identity):
+    """The row hashes of the last file loaded into the dataset and cycle with
+    the same identity columns, or an empty dict"""
+    name = storage.name(state_key(dataset_id, cycle_id))
+    if not storage.exists(name):
+        return {}
+    state = _read(storage, name)
+    if state['identity'] != list(identity):
+        return {}
+    return state['rows']
+
+
+def remember_state(storage, file_id, dataset_id, cycle_id, identity, hashes):
+    """Keep the row hashes of a new upload until it has been loaded"""
+    _write(storage, _pending_key(file_id), {
+        'state': state_key(dataset_id, cycle_id),
+        'identity': list(identity),
+        'rows': hashes})
+
+
+def save_state(storage, dataset_id, cycle_id, identity, hashes):
+    _write(storage, state_key(dataset_id, cycle_id),
+           {'identity': list(identity), 'rows': hashes})
+
+
+def commit_state(storage, file_id):
+    """Called once autoload_file has loaded the file. Only files uploaded
+    with upload_delta have hashes to save."""
+    name = storage.name(_pending_key(file_id))
+    if not storage.exists(name):
+        return
+    pending = _read(storage, name)
+    _write(storage, pending.pop('state'), pending)
+    storage.delete(name)
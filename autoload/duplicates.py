@@ -0,0 +1,149 @@
+"""Choosing between the property views that share an address"""
+from django.db.models import Count
+from seed.models.properties import PropertyAuditLog, PropertyView
+
+# tie-break policies, see DuplicateResolver
+LATEST_STATE = 'latest_state'
+MATCHING_CYCLE = 'matching_cycle'
+AUDIT_HISTORY = 'audit_history'
+POLICIES = (LATEST_STATE, MATCHING_CYCLE, AUDIT_HISTORY)
+
+
+class DuplicateResolver:
+    """Finds every (normalized_address, postal_code) of an organization that
+    has more than one property view and picks one of them with a tie-break
+    policy, so that green assessments for those addresses can be routed to a
+    view instead of being skipped.
+
+    policies is a sequence of policies applied in order until a single view
+    is left:
+
+        matching_cycle  keep the views in cycle
+        audit_history   keep the views with the most property audit logs
+        latest_state    keep the view whose state was created last
+
+    Addresses still left with more than one view are not resolved. Everything
+    is read by load() with one grouped query for the duplicated addresses
+    and one query each for their views and, if needed, audit log counts.
+
+    Given a cycle, only the views in that cycle count: an address is
+    duplicated if it has more than one view in the cycle, and
+    resolve_views() drops the views of other cycles, which takes a query
+    for the views it doesn't know yet.
+    """
+    def __init__(self, org, policies=(LATEST_STATE,), cycle=None):
+        for policy in policies:
+            if policy not in POLICIES:
+                raise ValueError('unknown duplicate policy: %r' % (policy,))
+        if MATCHING_CYCLE in policies and cycle is None:
+            raise ValueError('%s needs a cycle' % MATCHING_CYCLE)
+
+        self.org = org
+        self.policies = tuple(policies)
+        self.cycle_id = getattr(cycle, 'pk', cycle)
+        # (normalized_address, postal_code) -> view ids
+        self._duplicates = {}
+        # view id -> (cycle id, state id, number of audit logs)
+        self._views = {}
+
+    def _property_views(self):
+        views = PropertyView.objects.filter(state__organization=self.org)
+        if self.cycle_id is not None:
+            views = views.filter(cycle_id=self.cycle_id)
+        return views
+
+    def load(self):
+        keys = set(
+            (row['state__normalized_address'], row['state__postal_code'])
+            for row in self._property_views().filter(
+                state__normalized_address__isnull=False
+            ).values(
+                'state__normalized_address', 'state__postal_code'
+            ).annotate(views=Count('pk')).filter(views__gt=1).order_by())
+
+        self._duplicates = {}
+        self._views = {}
+        rows = self._property_views().filter(
+            state__normalized_address__in=set(address for (address, _) in keys)
+        ).values_list(
+            'state__normalized_address', 'state__postal_code', 'pk', 'cycle_id', 'state_id'
+        ).order_by('pk')
+        for (address, postal_code, view_id, cycle_id, state_id) in rows:
+            if (address, postal_code) in keys:
+                self._duplicates.setdefault((address, postal_code), []).append(view_id)
+                self._views[view_id] = (cycle_id, state_id, 0)
+
+        if AUDIT_HISTORY in self.policies:
+            for row in PropertyAuditLog.objects.filter(
+                    view_id__in=self._views).values('view_id').annotate(
+                        logs=Count('pk')).order_by():
+                (cycle_id, state_id, _) = self._views[row['view_id']]
+                self._views[row['view_id']] = (cycle_id, state_id, row['logs'])
+        return self
+
+    def _choose(self, view_ids):
+        """Returns (view id, deciding policy), or (None, None) if the
+        policies can't tell the views apart"""
+        if not view_ids or any(view_id not in self._views for view_id in view_ids):
+            # views created since load() can't be ranked
+            return None, None
+
+        candidates = list(view_ids)
+        for policy in self.policies:
+            if policy == MATCHING_CYCLE:
+                candidates = [v for v in candidates if self._views[v][0] == self.cycle_id]
+            else:
+                rank = 1 if policy == LATEST_STATE else 2
+                best = max(self._views[v][rank] for v in candidates)
+                candidates = [v for v in candidates if self._views[v][rank] == best]
+            if len(candidates) == 1:
+                return candidates[0], policy
+            if not candidates:
+                break
+        return None, None
+
+    def resolve(self, address, postal_code, view_ids=None):
+        """The view chosen for an address, or None. view_ids defaults to the
+        views found by load()."""
+        if view_ids is None:
+            view_ids = self._duplicates.get((address, postal_code), ())
+        return self._choose(view_ids)[0]
+
+    def resolve_views(self, views):
+        """Replace the view ids of the duplicated addresses in a dict of
+        (normalized_address, postal_code) -> view ids with the chosen view"""
+        in_cycle = None
+        if self.cycle_id is not None:
+            unknown = set(view_id for view_ids in views.values() if len(view_ids) > 1
+                          for view_id in view_ids if view_id not in self._views)
+            in_cycle = set(self._views)
+            if unknown:
+                in_cycle.update(PropertyView.objects.filter(
+                    pk__in=unknown, cycle_id=self.cycle_id).values_list('pk', flat=True))
+
+        for (key, view_ids) in views.items():
+            if len(view_ids) > 1:
+                if in_cycle is not None:
+                    view_ids = [view_id for view_id in view_ids if view_id in in_cycle]
+                    if len(view_ids) == 1:
+                        views[key] = view_ids
+                        continue
+                view_id = self.resolve(key[0], key[1], view_ids)
+                if view_id is not None:
+                    views[key] = [view_id]
+        return views
+
+    def report(self):
+        """A list with an entry for each duplicated address, ordered by
+        address, giving its view ids, the view chosen (None if unresolved)
+        and the policy that chose it. Entries only hold strings, ints and
+        lists so the report can be written out as JSON."""
+        report = []
+        for key in sorted(self._duplicates, key=lambda key: (key[0], key[1] or '')):
+            (view_id, policy) = self._choose(self._duplicates[key])
+            report.append({'normalized_address': key[0],
+                           'postal_code': key[1],
+                           'view_ids': self._duplicates[key],
+                           'view_id': view_id,
+                           'policy': policy})
+        return report
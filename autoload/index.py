@@ -0,0 +1,87 @@
+"""In-memory lookup of property views by address"""
+import sys
+
+from django.db.models import Q
+from seed.models.properties import PropertyState, PropertyView
+
+
+def in_or_null(field, values):
+    """Filter matching a field against a set of values that may include
+    None, which a plain __in lookup never matches"""
+    values = set(values)
+    condition = Q(**{field + '__in': values - set([None])})
+    if None in values:
+        condition |= Q(**{field + '__isnull': True})
+    return condition
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ViewIndex:
+    """Maps (normalized_address, postal_code) to the ids of the property
+    views of an organization.
+
+    The index is built with a single scan of the view table. Addresses with a
+    single view, by far the common case, store the bare id and only
+    duplicated addresses store a tuple of ids. Address strings are interned
+    so keys shared with other records don't take up extra memory.
+    """
+    def __init__(self, org):
+        self.org = org
+        self._views = {}
+
+    def __len__(self):
+        return len(self._views)
+
+    def _rows(self, *conditions):
+        return PropertyView.objects.filter(
+            *conditions, state__organization=self.org
+        ).values_list(
+            'state__normalized_address', 'state__postal_code', 'pk'
+        ).order_by('pk').iterator()
+
+    def _add(self, rows):
+        views = self._views
+        for (address, postal_code, view_id) in rows:
+            key = (_intern(address), _intern(postal_code))
+            current = views.get(key)
+            if current is None:
+                views[key] = view_id
+            elif isinstance(current, tuple):
+                views[key] = current + (view_id,)
+            else:
+                views[key] = (current, view_id)
+
+    def load(self):
+        """(Re)build the index from the database"""
+        self._views = {}
+        self._add(self._rows())
+        return self
+
+    def update_from_file(self, file_id):
+        """Refresh the entries for every address in an import file, e.g.
+        after matching has merged its records into existing views"""
+        keys = set(PropertyState.objects.filter(
+            import_file_id=file_id
+        ).values_list('normalized_address', 'postal_code'))
+        for key in keys:
+            self._views.pop(key, None)
+        rows = self._rows(
+            in_or_null('state__normalized_address', (address for (address, _) in keys)))
+        self._add(row for row in rows if (row[0], row[1]) in keys)
+
+    def get(self, address, postal_code):
+        """Returns a tuple with the ids of all views at the address"""
+        view_ids = self._views.get((address, postal_code), ())
+        if isinstance(view_ids, tuple):
+            return view_ids
+        return (view_ids,)
+
+    def duplicates(self):
+        """Yields ((normalized_address, postal_code), view_ids) for every
+        address that has more than one view"""
+        for (key, view_ids) in self._views.items():
+            if isinstance(view_ids, tuple):
+                yield key, view_ids
@@ -0,0 +1,190 @@
+"""Load green assessments from csv or JSON lines files"""
+import csv
+import datetime
+import io
+import json
+import re
+
+from .autoload import BATCH_SIZE
+
+# fields of a record that are passed on to the green assessment property
+TEXT_FIELDS = ('source', 'status', 'rating', 'version', 'reference_id')
+DATE_FIELDS = ('date', 'target_date', 'status_date')
+TRUE_VALUES = ('1', 'true', 't', 'yes', 'y')
+FALSE_VALUES = ('0', 'false', 'f', 'no', 'n')
+
+
+def read_rows(f, format):
+    """Yields (line number, row) for each row of a csv or JSON lines file.
+    csv rows are dicts and JSON lines are left to parse_row."""
+    if format == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for (line_num, line) in enumerate(f, 1):
+            if line.strip():
+                yield line_num, line
+
+
+def parse_row(row, lookups):
+    """Validate a row and convert it to an (assessment_data, address,
+    postal_code) record. Raises ValueError describing the first problem."""
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except ValueError:
+            raise ValueError('invalid JSON')
+        if not isinstance(row, dict):
+            raise ValueError('not a JSON object')
+
+    row = dict((k.strip(), v) for (k, v) in row.items()
+               if k is not None and v not in (None, ''))
+
+    for field in ('address', 'postal_code', 'assessment'):
+        if field not in row:
+            raise ValueError('missing %s' % field)
+    address = str(row.pop('address'))
+    postal_code = str(row.pop('postal_code'))
+
+    try:
+        assessment_data = {'assessment': lookups.assessment(row.pop('assessment'))}
+    except KeyError as e:
+        raise ValueError(e.args[0])
+
+    for field in TEXT_FIELDS:
+        if field in row:
+            assessment_data[field] = str(row.pop(field))
+    for field in DATE_FIELDS:
+        if field in row:
+            assessment_data[field] = _date(field, row.pop(field))
+    if 'metric' in row:
+        assessment_data['metric'] = _number('metric', row.pop('metric'))
+    if 'eligibility' in row:
+        assessment_data['eligibility'] = _bool('eligibility', row.pop('eligibility'))
+    if 'urls' in row:
+        assessment_data['urls'] = _urls(row.pop('urls'))
+
+    if row:
+        raise ValueError('unknown fields: %s' % ', '.join(sorted(row)))
+    return assessment_data, address, postal_code
+
+
+def _date(field, value):
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(str(value).strip(), '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('%s is not a YYYY-MM-DD date: %r' % (field, value))
+
+
+def _number(field, value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('%s is not a number: %r' % (field, value))
+    return int(number) if number.is_integer() else number
+
+
+def _bool(field, value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError('%s is not true or false: %r' % (field, value))
+
+
+def _urls(value):
+    """urls are a JSON array, or in csv files either a JSON array or urls
+    separated by whitespace or |"""
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith('['):
+            value = json.loads(value)
+        else:
+            value = re.split(r'[\s|]+', value)
+    if not isinstance(value, list):
+        raise ValueError('urls is not a list: %r' % (value,))
+    return [str(url) for url in value if url]
+
+
+def count_results(results, summary):
+    """Add the results of create_green_assessment_properties to the counts
+    in summary"""
+    for result in results:
+        if result is None:
+            summary['duplicates'] += 1
+        elif 'error' in result[0]:
+            summary['rejected'] += 1
+        elif result[0]['created']:
+            summary['created'] += 1
+        elif result[0]['updated']:
+            summary['updated'] += 1
+        else:
+            summary['unchanged'] += 1
+
+
+def load_green_assessments(loader, source, format=None, batch_size=BATCH_SIZE,
+                           errors=None):
+    """Stream green assessments from a csv or JSON lines file into
+    loader.create_green_assessment_properties, batch_size records at a time.
+
+    source is a path or a text file object. The format is 'csv' or 'jsonl'
+    and defaults to what the file name suggests, or csv. Columns are the
+    fields of create_green_assessment_property plus address (normalized)
+    and postal_code; assessment may be an id, name or award body.
+
+    Rows that fail validation or match no property view, as well as every
+    row of a batch that fails to save, are skipped and written to errors, if given, as csv lines of
+    (line number, reason). Returns counts of the rows created, updated,
+    unchanged, skipped as duplicate addresses and rejected.
+    """
+    if isinstance(source, str):
+        if format is None:
+            format = 'jsonl' if re.search(r'\.(jsonl|ndjson|json)$', source) else 'csv'
+        with io.open(source, newline='', encoding='utf-8') as f:
+            return load_green_assessments(loader, f, format, batch_size, errors)
+
+    summary = {'created': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0, 'rejected': 0}
+    error_writer = csv.writer(errors) if errors is not None else None
+
+    def reject(line_num, reason):
+        summary['rejected'] += 1
+        if error_writer is not None:
+            error_writer.writerow([line_num, reason])
+
+    def flush(batch):
+        try:
+            results = loader.create_green_assessment_properties(
+                [record for (_, record) in batch])
+        except Exception as e:
+            for (line_num, _) in batch:
+                reject(line_num, 'batch failed: %s' % e)
+            return
+        for ((line_num, _), result) in zip(batch, results):
+            if result is not None and 'error' in result[0]:
+                reject(line_num, result[0]['error'])
+            else:
+                count_results([result], summary)
+
+    with loader.lookup_cache() as lookups:
+        batch = []
+        for (line_num, row) in read_rows(source, format or 'csv'):
+            try:
+                batch.append((line_num, parse_row(row, lookups)))
+            except ValueError as e:
+                reject(line_num, str(e))
+                continue
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+    return summary
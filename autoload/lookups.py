@@ -0,0 +1,93 @@
+"""Memoized lookups of green assessments and HELIX measurements"""
+import collections
+
+from helix.models import HelixMeasurement
+from seed.models.certification import GreenAssessment
+
+# fields identifying a measurement of a green assessment property
+MEASUREMENT_KEY = ('assessment_property_id', 'measurement_type', 'measurement_subtype', 'fuel')
+
+
+class LookupCache:
+    """Resolves the green assessments and measurements referenced by a batch
+    of green assessment records.
+
+    All green assessments of the organization are read with one query the
+    first time one is needed and can then be looked up by instance, id, name
+    or award body.
+
+    Measurements are not read automatically: green assessment records don't
+    refer to measurements, so nothing in the batch path needs them. Callers
+    that do call prime_measurements() with the assessment properties of a
+    batch to read them in one query; they are kept in an LRU of at most
+    max_measurements entries and measurement() queries any it misses.
+    """
+    def __init__(self, org, max_measurements=100000):
+        self.org = org
+        self.max_measurements = max_measurements
+        self._assessments = None
+        self._measurements = collections.OrderedDict()
+
+    def load(self):
+        by_id = {}
+        by_name = {}
+        by_award_body = {}
+        for assessment in GreenAssessment.objects.filter(organization=self.org):
+            by_id[assessment.pk] = assessment
+            by_name.setdefault(assessment.name, []).append(assessment)
+            by_award_body.setdefault(assessment.award_body, []).append(assessment)
+        self._assessments = (by_id, by_name, by_award_body)
+        return self
+
+    def assessment(self, ref):
+        """The green assessment for an instance, id, name or award body.
+        Names and award bodies only resolve if they have a single
+        assessment."""
+        if isinstance(ref, GreenAssessment):
+            return ref
+        if self._assessments is None:
+            self.load()
+
+        (by_id, by_name, by_award_body) = self._assessments
+        if isinstance(ref, int) and ref in by_id:
+            return by_id[ref]
+        if isinstance(ref, str) and ref.isdigit() and int(ref) in by_id:
+            return by_id[int(ref)]
+        for candidates in (by_name.get(ref), by_award_body.get(ref)):
+            if candidates is None:
+                continue
+            if len(candidates) > 1:
+                raise KeyError('ambiguous green assessment: %r' % (ref,))
+            return candidates[0]
+        raise KeyError('unknown green assessment: %r' % (ref,))
+
+    def prime_measurements(self, assessment_property_ids):
+        """Read the measurements of the given assessment properties"""
+        for measurement in HelixMeasurement.objects.filter(
+                assessment_property_id__in=assessment_property_ids):
+            self._remember(_measurement_key(measurement), measurement)
+
+    def measurement(self, assessment_property, measurement_type,
+                    measurement_subtype=None, fuel=None):
+        """The measurement with the given natural key, or None. Measurements
+        not read by prime_measurements() are fetched one at a time."""
+        key = (getattr(assessment_property, 'pk', assessment_property),
+               measurement_type, measurement_subtype, fuel)
+        if key in self._measurements:
+            self._measurements.move_to_end(key)
+            return self._measurements[key]
+
+        measurement = HelixMeasurement.objects.filter(
+            **dict(zip(MEASUREMENT_KEY, key))).first()
+        self._remember(key, measurement)
+        return measurement
+
+    def _remember(self, key, measurement):
+        self._measurements[key] = measurement
+        self._measurements.move_to_end(key)
+        while len(self._measurements) > self.max_measurements:
+            self._measurements.popitem(last=False)
+
+
+def _measurement_key(measurement):
+    return tuple(getattr(measurement, field) for field in MEASUREMENT_KEY)
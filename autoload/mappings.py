@@ -0,0 +1,99 @@
+"""Cache of the column mappings already created for an organization"""
+import collections
+import hashlib
+import json
+import threading
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from seed.models import Column, ColumnMapping
+
+
+def mapping_hash(mappings):
+    """Hash of a list of column mappings that doesn't depend on their order"""
+    canonical = sorted(
+        [m['from_field'], m['to_field'], m['to_table_name']] for m in mappings)
+    return hashlib.sha1(json.dumps(canonical).encode('utf-8')).hexdigest()
+
+
+def _generation_key(org_id):
+    return 'autoload:columns:%s' % org_id
+
+
+def columns_generation(org_id):
+    """Counter that changes whenever a column of the organization changes"""
+    return cache.get(_generation_key(org_id), 0)
+
+
+def _columns_changed(sender, instance, **kwargs):
+    org_id = getattr(instance, 'organization_id', None)
+    if org_id is None:
+        org_id = getattr(instance, 'super_organization_id', None)
+    if org_id is None:
+        return
+
+    key = _generation_key(org_id)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # expired between add and incr
+        cache.set(key, 1, None)
+
+
+post_save.connect(_columns_changed, sender=Column)
+post_delete.connect(_columns_changed, sender=Column)
+post_save.connect(_columns_changed, sender=ColumnMapping)
+post_delete.connect(_columns_changed, sender=ColumnMapping)
+
+
+class MappingProfileCache:
+    """Remembers which mapping lists have already been created for an
+    organization, together with the column mappings to store on the import
+    file.
+
+    Entries live in a per process LRU backed by the django cache and are
+    keyed by organization, the generation of its columns and the hash of the
+    mapping list, so any change to the organization's columns invalidates
+    them.
+    """
+    def __init__(self, maxsize=128, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._profiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, org_id, mappings):
+        return 'autoload:mappings:%s:%s:%s' % (
+            org_id, columns_generation(org_id), mapping_hash(mappings))
+
+    def get(self, org_id, mappings):
+        key = self._key(org_id, mappings)
+        with self._lock:
+            if key in self._profiles:
+                self._profiles.move_to_end(key)
+                return self._profiles[key]
+
+        column_mappings = cache.get(key)
+        if column_mappings is not None:
+            self._remember(key, column_mappings)
+        return column_mappings
+
+    def set(self, org_id, mappings, column_mappings):
+        key = self._key(org_id, mappings)
+        cache.set(key, column_mappings, self.timeout)
+        self._remember(key, column_mappings)
+
+    def _remember(self, key, column_mappings):
+        with self._lock:
+            self._profiles[key] = column_mappings
+            self._profiles.move_to_end(key)
+            while len(self._profiles) > self.maxsize:
+                self._profiles.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+
+mapping_cache = MappingProfileCache()
@@ -0,0 +1,206 @@
+"""Timing and throughput metrics for the autoload pipeline"""
+import collections
+import re
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.apps import apps
+from django.db import connection
+
+# the table a statement reads or writes first
+TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)"?', re.IGNORECASE)
+
+_table_models = None
+
+
+def classify(sql):
+    """(model label, statement type) of a query, e.g. ('seed.PropertyView',
+    'SELECT'). Tables without a model are given by name and statements
+    without a table, such as savepoints, as None."""
+    global _table_models
+    if _table_models is None:
+        _table_models = dict((model._meta.db_table, model._meta.label)
+                             for model in apps.get_models(include_auto_created=True))
+
+    words = sql.split(None, 1)
+    statement = words[0].upper() if words else ''
+    match = TABLE.search(sql)
+    if match is None:
+        return None, statement
+    return _table_models.get(match.group(1), match.group(1)), statement
+
+
+class MemorySink:
+    """Default metrics sink, keeps the most recent runs in memory"""
+    def __init__(self, maxlen=1000):
+        self.records = collections.deque(maxlen=maxlen)
+
+    def __call__(self, name, metrics):
+        self.records.append((name, metrics))
+
+
+class QueryLog:
+    """Database execute wrapper recording the SQL of the queries that pass
+    through it"""
+    def __init__(self):
+        self.queries = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+    def breakdown(self, queries=None):
+        """Number of queries by (model label, statement type)"""
+        return collections.Counter(classify(sql) for sql in (
+            self.queries if queries is None else queries))
+
+
+class QueryBudgetMixin:
+    """TestCase mixin for keeping the number of queries a method makes in
+    check, so that a lazy relation access turning a batch into N+1 queries
+    fails a test:
+
+        with self.assertQueryBudget(per_batch=5, per_record=2, records=len(records)):
+            loader.create_green_assessment_properties(records)
+
+    The budget is per_batch queries for each of batches plus per_record for
+    each of records. expected optionally maps (model label, statement type)
+    to the number of queries expected of it, and more queries than expected
+    of any of them fails as well. Failures list every query, counted by
+    model and statement type next to the expected counts, and their SQL.
+    """
+    @contextmanager
+    def assertQueryBudget(self, per_batch=0, per_record=0, records=0, batches=1, expected=None):
+        log = QueryLog()
+        with connection.execute_wrapper(log):
+            yield log
+        self.assertWithinQueryBudget(log, per_batch, per_record, records, batches, expected)
+
+    def assertWithinQueryBudget(self, log, per_batch=0, per_record=0, records=0, batches=1,
+                                expected=None):
+        budget = per_batch * batches + per_record * records
+        breakdown = log.breakdown()
+        expected = expected or {}
+        if len(log) <= budget and all(
+                count <= expected.get(key, count) for (key, count) in breakdown.items()):
+            return
+
+        lines = ['%d queries for a budget of %d (%d per batch for %d batches, '
+                 '%d per record for %d records)' % (
+                     len(log), budget, per_batch, batches, per_record, records),
+                 'queries by model:']
+        for key in sorted(set(breakdown) | set(expected),
+                          key=lambda key: (-breakdown[key], key[1] or '', key[0] or '')):
+            (model, statement) = key
+            line = '  %d %s %s' % (breakdown[key], statement, model or '-')
+            if key in expected:
+                line += ' (expected %d, %+d)' % (expected[key], breakdown[key] - expected[key])
+            lines.append(line)
+        lines.append('sql:')
+        lines.extend('  %d. %s' % (i, sql) for (i, sql) in enumerate(log.queries, 1))
+        self.fail('\n'.join(lines))
+
+
+class Metrics:
+    """Collects wall time, time spent waiting on celery, query counts and
+    throughput for one call of an autoload method, broken down by stage.
+    Queries are also counted by model and statement type.
+
+    Usage:
+
+        with Metrics('autoload_file') as metrics:
+            with metrics.stage('save_raw_data'):
+                ...
+                with metrics.waiting():
+                    ...
+
+    Entering the metrics times the run and counts the queries made by the
+    current thread. Runs that move between threads use timed() for the
+    run and counting() around the work done in each thread instead.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.totals = {'wall': 0.0, 'waiting': 0.0, 'queries': 0}
+        self.queries_by_model = collections.Counter()
+        self.stages = collections.OrderedDict()
+        self._current = []
+        self._exit_stack = None
+
+    def __enter__(self):
+        self._exit_stack = ExitStack()
+        self._exit_stack.enter_context(self.timed())
+        self._exit_stack.enter_context(self.counting())
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._exit_stack.__exit__(*exc_info)
+
+    def __call__(self, execute, sql, params, many, context):
+        # database execute wrapper, see counting()
+        self.totals['queries'] += 1
+        self.queries_by_model[classify(sql)] += 1
+        for totals in self._current:
+            totals['queries'] += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def timed(self):
+        """Add the time spent in the block to the run's wall time"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.totals['wall'] += time.time() - start
+
+    def counting(self):
+        """Count the queries made by the current thread within the block"""
+        return connection.execute_wrapper(self)
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage. Stages run more than once are added up."""
+        totals = self.stages.setdefault(
+            name, {'wall': 0.0, 'waiting': 0.0, 'queries': 0})
+        self._current.append(totals)
+        start = time.time()
+        try:
+            yield
+        finally:
+            totals['wall'] += time.time() - start
+            self._current.pop()
+
+    @contextmanager
+    def waiting(self):
+        """Count the time spent in the block as waiting rather than working"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.totals['waiting'] += elapsed
+            for totals in self._current:
+                totals['waiting'] += elapsed
+
+    def as_dict(self):
+        def summary(totals):
+            summary = dict(totals)
+            summary['working'] = totals['wall'] - totals['waiting']
+            return summary
+
+        result = summary(self.totals)
+        result['rows'] = self.rows
+        if self.rows is not None and self.totals['wall'] > 0:
+            result['rows_per_second'] = self.rows / self.totals['wall']
+        else:
+            result['rows_per_second'] = None
+        queries_by_model = {}
+        for ((model, statement), count) in self.queries_by_model.items():
+            queries_by_model.setdefault(model or '-', {})[statement] = count
+        result['queries_by_model'] = queries_by_model
+        result['stages'] = collections.OrderedDict(
+            (name, summary(totals)) for (name, totals) in self.stages.items())
+        return result
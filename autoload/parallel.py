@@ -0,0 +1,116 @@
+"""Load green assessments on several processes
+
+Records are partitioned by postal code so that all the records of a postal
+code, and so of any property view, are loaded by the same process. Each
+process has its own database connection.
+
+Only the standard library and django.db, which doesn't need the apps to be
+loaded, are imported at module level so that worker processes that don't
+fork can import this module before django is set up.
+"""
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import connections
+
+
+def _empty_summary():
+    return {'created': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0,
+            'rejected': 0, 'errors': []}
+
+
+def merge_summaries(summaries):
+    """Add up the summaries of several partitions"""
+    summary = _empty_summary()
+    for result in summaries:
+        for (key, value) in result.items():
+            summary[key] += value
+    return summary
+
+
+def partition(records, partitions):
+    """Split (assessment_data, address, postal_code) records into at most
+    partitions lists, keeping the records of each postal code together"""
+    parts = [[] for _ in range(partitions)]
+    for record in records:
+        postal_code = str(record[2]).encode('utf-8')
+        parts[zlib.crc32(postal_code) % partitions].append(record)
+    return [part for part in parts if part]
+
+
+def _load_partition(user_id, org_id, records, duplicate_policies=None, cycle_id=None):
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+    from seed.landing.models import SEEDUser
+    from seed.lib.superperms.orgs.models import Organization
+    from .autoload import BATCH_SIZE, AutoLoad
+    from .ingest import count_results
+
+    summary = _empty_summary()
+    try:
+        loader = AutoLoad(SEEDUser.objects.get(pk=user_id),
+                          Organization.objects.get(pk=org_id))
+        if duplicate_policies is not None:
+            loader.load_duplicate_resolver(duplicate_policies, cycle_id)
+        with loader.lookup_cache():
+            # each batch is committed on its own, so it is counted on its own
+            for start in range(0, len(records), BATCH_SIZE):
+                batch = records[start:start + BATCH_SIZE]
+                try:
+                    results = loader.create_green_assessment_properties(batch)
+                except Exception as e:
+                    summary['rejected'] += len(batch)
+                    summary['errors'].append(str(e))
+                else:
+                    count_results(results, summary)
+    except Exception as e:
+        # the worker couldn't be set up, nothing was loaded
+        summary = _empty_summary()
+        summary['rejected'] = len(records)
+        summary['errors'].append(str(e))
+    finally:
+        connections.close_all()
+    return summary
+
+
+def load_green_assessments_parallel(loader, records, processes=None,
+                                    partitions_per_process=4):
+    """Load (assessment_data, address, postal_code) records like
+    loader.create_green_assessment_properties, on a pool of processes.
+
+    Records are split into processes * partitions_per_process partitions by
+    postal code and each partition is loaded by one worker, BATCH_SIZE
+    records per transaction. Returns the combined counts of created,
+    updated, unchanged, duplicate and rejected records along with the
+    errors of any batches that failed.
+
+    Workers use a loader of their own. They resolve duplicated addresses
+    with the same policies if loader has a duplicate resolver loaded, but
+    don't share its view index, which would have to be loaded again by each
+    worker, and don't report metrics to its metrics sink.
+    """
+    processes = processes or os.cpu_count() or 1
+
+    # assessments are sent to the workers by id
+    records = [(dict(assessment_data, assessment=getattr(
+                    assessment_data['assessment'], 'pk', assessment_data['assessment'])),
+                address, postal_code)
+               for (assessment_data, address, postal_code) in records]
+    parts = partition(records, processes * partitions_per_process)
+
+    # connections must not be shared with forked workers
+    connections.close_all()
+
+    resolver = loader.duplicate_resolver
+    duplicate_policies = resolver.policies if resolver is not None else None
+    cycle_id = resolver.cycle_id if resolver is not None else None
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_load_partition, loader.user.pk, loader.org.pk, part,
+                                   duplicate_policies, cycle_id)
+                   for part in parts]
+        return merge_summaries(future.result() for future in futures)
@@ -0,0 +1,138 @@
+"""Quick checks of an uploaded csv file before it is sent through the
+celery stages of autoload_file"""
+import collections
+import csv
+import datetime
+import difflib
+import io
+
+# Number of data rows read to guess column types and the size of a row
+SAMPLE_ROWS = 1000
+
+# Never read more than this many bytes of a file, however long its rows
+SAMPLE_BYTES = 1024 * 1024
+
+# Number of bytes read at a time
+READ_SIZE = 64 * 1024
+
+# Files with these extensions aren't csv and aren't profiled
+EXCEL_EXTENSIONS = ('.xls', '.xlsx')
+
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y')
+
+# column types from most to least specific; a column has the least specific
+# type of its values
+TYPES = ('empty', 'integer', 'float', 'date', 'text')
+
+
+def read_sample(f, sample_rows=SAMPLE_ROWS, max_bytes=SAMPLE_BYTES):
+    """Reads the first lines of a binary file, enough for the header and
+    sample_rows rows. Returns (text, complete) where complete is True if
+    the whole file was read; otherwise text ends at the last full line."""
+    sample = b''
+    complete = False
+    while sample.count(b'\n') <= sample_rows and len(sample) < max_bytes:
+        data = f.read(READ_SIZE)
+        if not data:
+            complete = True
+            break
+        sample += data
+
+    if not complete:
+        sample = sample[:sample.rfind(b'\n') + 1]
+    return sample.decode('utf-8-sig', errors='replace'), complete
+
+
+def value_type(value):
+    value = value.strip()
+    if not value:
+        return 'empty'
+    try:
+        int(value)
+        return 'integer'
+    except ValueError:
+        pass
+    try:
+        float(value)
+        return 'float'
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            datetime.datetime.strptime(value, date_format)
+            return 'date'
+        except ValueError:
+            pass
+    return 'text'
+
+
+def _combine(type_a, type_b):
+    if type_a == 'empty' or type_a == type_b:
+        return type_b
+    if type_b == 'empty':
+        return type_a
+    if set((type_a, type_b)) == set(('integer', 'float')):
+        return 'float'
+    return 'text'
+
+
+def profile(f, size=None, sample_rows=SAMPLE_ROWS):
+    """Profile a csv file from its first rows.
+
+    f is a binary file and size its length in bytes, if known. Returns a dict
+    with the header columns, the type of each column (empty, integer, float,
+    date or text) in the sampled rows and the number of data rows, which is
+    estimated from the size of the sampled rows unless the whole file fit in
+    the sample."""
+    (text, complete) = read_sample(f, sample_rows)
+    reader = csv.reader(io.StringIO(text, newline=''))
+    header = next(reader, [])
+
+    column_types = collections.OrderedDict((column, 'empty') for column in header)
+    rows = 0
+    for row in reader:
+        if not any(value.strip() for value in row):
+            continue
+        rows += 1
+        for (column, value) in zip(header, row):
+            column_types[column] = _combine(column_types[column], value_type(value))
+        if rows >= sample_rows:
+            break
+
+    if complete or not rows or not size:
+        estimated_rows = rows
+    else:
+        # average bytes per line, header included
+        line_size = len(text.encode('utf-8')) / float(rows + 1)
+        estimated_rows = max(rows, int(size / line_size) - 1)
+
+    return {'columns': header,
+            'column_types': column_types,
+            'sample_rows': rows,
+            'estimated_rows': estimated_rows,
+            'exact': complete}
+
+
+def check_mappings(columns, col_mappings):
+    """The problems that would keep col_mappings from mapping a file with
+    the given header columns, as a list of messages"""
+    problems = []
+    if not columns:
+        return ['file has no header']
+
+    duplicates = sorted(set(c for c in columns if columns.count(c) > 1))
+    if duplicates:
+        problems.append('duplicate columns: %s' % ', '.join(repr(c) for c in duplicates))
+
+    for mapping in col_mappings:
+        field = mapping['from_field']
+        if field in columns:
+            continue
+        # usually stray whitespace or a difference in case
+        suggestions = ([c for c in columns if c.strip().lower() == field.strip().lower()] or
+                       difflib.get_close_matches(field, columns, 1))
+        if suggestions:
+            problems.append('column %r not found, did you mean %r?' % (field, suggestions[0]))
+        else:
+            problems.append('column %r not found' % (field,))
+    return problems
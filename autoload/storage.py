@@ -0,0 +1,193 @@
+"""Where AutoLoad.upload stores files
+
+A backend stores an upload under a key and returns the name to save in the
+import file, which is how SEED's tasks find it again:
+
+    name = backend.write(key, chunks)    # same as backend.name(key)
+    f = backend.open_read(name)
+    f = backend.open_read(name, max_bytes)    # at least the first max_bytes
+
+Reading with max_bytes doesn't fetch more of a file than that from a
+bucket, which reading the file opened without it may do.
+
+Keys are made by file_key() and never collide: they contain either the
+sha256 of the content or a random uuid.
+"""
+import io
+import mmap
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+
+# prefix of the keys of uploaded files
+KEY_PREFIX = 'data_imports'
+
+
+def file_key(filename, digest=None):
+    """The key to store an upload under. Content with a known sha256 digest
+    always gets the same key, anything else a unique one. Every key is in
+    the same directory so that uploads don't each create one."""
+    return '%s/%s-%s' % (KEY_PREFIX, digest or uuid.uuid4().hex, os.path.basename(filename))
+
+
+class LocalStorage:
+    """Stores uploads on local disk under root (MEDIA_ROOT/uploads by
+    default). Import files get the absolute path, so SEED's tasks read the
+    file in place, and open_read() memory maps it rather than copying it."""
+
+    def __init__(self, root=None):
+        self.root = root or os.path.join(settings.MEDIA_ROOT, 'uploads')
+        # directories known to exist
+        self._dirs = set()
+        self._lock = threading.Lock()
+
+    def name(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, name):
+        return os.path.exists(name)
+
+    def size(self, name):
+        return os.path.getsize(name)
+
+    def delete(self, name):
+        os.remove(name)
+
+    def _makedirs(self, directory):
+        with self._lock:
+            if directory in self._dirs:
+                return
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._dirs.add(directory)
+
+    def write(self, key, chunks):
+        path = self.name(key)
+        self._makedirs(os.path.dirname(path))
+        # keys are reused for identical content, so a file only appears under
+        # its name once it is complete
+        temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return path
+
+    def open_read(self, name, max_bytes=None):
+        # mapped pages are only read from disk when they are accessed
+        f = open(name, 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                return f
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return f
+        f.close()
+        return mapped
+
+
+class DjangoStorage:
+    """Stores uploads with a django storage, e.g. django-storages' S3 storage
+    which writes files opened for writing as multipart uploads. The storage
+    instance, and with it its boto3 connection, is shared by every upload."""
+
+    def __init__(self, storage=None):
+        self.storage = storage if storage is not None else default_storage
+
+    def name(self, key):
+        return key
+
+    def exists(self, name):
+        return self.storage.exists(name)
+
+    def size(self, name):
+        return self.storage.size(name)
+
+    def delete(self, name):
+        self.storage.delete(name)
+
+    def write(self, key, chunks):
+        f = self.storage.open(key, 'wb')
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+        finally:
+            f.close()
+        return key
+
+    def open_read(self, name, max_bytes=None):
+        f = self.storage.open(name, 'rb')
+        # django-storages' S3 files download the whole object on the first
+        # read, the boto3 object they wrap can get a range instead
+        obj = getattr(f, 'obj', None)
+        if max_bytes is None or obj is None or not hasattr(obj, 'get'):
+            return f
+        try:
+            # a range past the end of the object is an error
+            max_bytes = min(max_bytes, obj.content_length)
+            if max_bytes <= 0:
+                return io.BytesIO()
+            body = obj.get(Range='bytes=0-%d' % (max_bytes - 1))['Body']
+            try:
+                return io.BytesIO(body.read())
+            finally:
+                body.close()
+        finally:
+            f.close()
+
+
+class MemoryStorage:
+    """Keeps uploads in a dict, for tests and benchmarks that shouldn't touch
+    disk or a bucket. SEED's tasks can't read these files."""
+
+    def __init__(self):
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def name(self, key):
+        return key
+
+    def exists(self, name):
+        with self._lock:
+            return name in self.files
+
+    def size(self, name):
+        with self._lock:
+            return len(self.files[name])
+
+    def delete(self, name):
+        with self._lock:
+            del self.files[name]
+
+    def write(self, key, chunks):
+        content = b''.join(chunks)
+        with self._lock:
+            self.files[key] = content
+        return key
+
+    def open_read(self, name, max_bytes=None):
+        with self._lock:
+            return io.BytesIO(self.files[name][:max_bytes])
+
+
+_default_backend = None
+
+
+def default_backend():
+    """The backend for the default django storage: local disk for a file
+    system storage and the storage itself for anything else"""
+    global _default_backend
+    if _default_backend is None:
+        if isinstance(default_storage, FileSystemStorage):
+            _default_backend = LocalStorage()
+        else:
+            _default_backend = DjangoStorage()
+    return _default_backend
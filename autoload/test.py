@@ -1,18 +1,43 @@
 """Test for the autoload module"""
+import asyncio
 import autoload
 import datetime
-
-from django.test import TestCase
+import io
+import itertools
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from autoload.aio import AsyncAutoLoad
+from autoload.autoload import CHUNK_SIZE, task_notifier
+from autoload.checkpoint import Checkpoint
+
+from autoload.dedup import PENDING_TIMEOUT, mark_loaded
+from autoload.delta import commit_state
+from autoload.ingest import load_green_assessments
+from autoload.mappings import mapping_cache
+from autoload.metrics import MemorySink, QueryBudgetMixin
+from autoload.parallel import _load_partition, merge_summaries, partition
+from autoload.storage import DjangoStorage, LocalStorage, MemoryStorage, file_key
+
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
 from seed.landing.models import SEEDUser as User
-from seed.models.properties import PropertyState
-from seed.models.certification import GreenAssessment, GreenAssessmentProperty
+from seed.models.properties import Property, PropertyState, PropertyView
+from seed.models.certification import (
+    GreenAssessment,
+    GreenAssessmentProperty,
+    GreenAssessmentPropertyAuditLog,
+    GreenAssessmentURL
+)
 from seed.lib.superperms.orgs.models import Organization, OrganizationUser
-from seed.models import Cycle
-from seed.data_importer.models import ImportRecord
+from seed.models import Column, Cycle
+from seed.data_importer.models import ImportFile, ImportRecord
 
 
-class AutoloadTest(TestCase):
+class AutoloadTest(QueryBudgetMixin, TestCase):
 
     def setUp(self):
         self.user = User.objects.create(username='test_user@demo.com')
@@ -60,6 +85,17 @@ class AutoloadTest(TestCase):
                 organization=self.org)
         self.cycle.save()
 
+    # create a property view directly, bypassing the import pipeline
+    def create_view(self, address, postal_code):
+        state = PropertyState.objects.create(
+            organization=self.org,
+            address_line_1=address,
+            postal_code=postal_code)
+        return PropertyView.objects.create(
+            property=Property.objects.create(organization=self.org),
+            cycle=self.cycle,
+            state=state)
+
     # test that autoload returns with succes and that there exists a
     # property state with the correct file_id
     def test_autoload(self):
@@ -70,7 +106,7 @@ class AutoloadTest(TestCase):
             {"from_field": "Score",
              "to_field": "energy_score",
              "to_table_name": "PropertyState"}]
-        data = 'Address, klfjgkldsjg\n123 Test Road, 100'
+        data = 'Address,Score\n123 Test Road,100'
 
         resp = self.loader.autoload_file(data, self.dataset, self.cycle, col_mappings)
         self.assertEqual(resp['status'], 'success')
@@ -89,7 +125,7 @@ class AutoloadTest(TestCase):
              "to_field": "energy_score",
              "to_table_name": "PropertyState"}]
 
-        file_handle = 'Address, klfjgkldsjg\n123 Test Road, 100'
+        file_handle = 'Address,Score\n123 Test Road,100'
         dataset_name = 'TEST'
 
         resp = self.loader.autoload_file(file_handle, self.dataset, self.cycle, col_mappings)
@@ -118,7 +154,7 @@ class AutoloadTest(TestCase):
              "to_field": "energy_score",
              "to_table_name": "PropertyState"}]
 
-        file_handle = 'Address, klfjgkldsjg\n123 Test Road, 100'
+        file_handle = 'Address,Score\n123 Test Road,100'
         dataset_name = 'TEST'
 
         resp = self.loader.autoload_file(file_handle, self.dataset, self.cycle, col_mappings)
@@ -158,7 +194,7 @@ class AutoloadTest(TestCase):
              "to_field": "energy_score",
              "to_table_name": "PropertyState"}]
 
-        file_handle = 'Address, klfjgkldsjg\n123 Test Road, 100'
+        file_handle = 'Address,Score\n123 Test Road,100'
         dataset_name = 'TEST'
 
         resp = self.loader.autoload_file(file_handle, self.dataset, self.cycle, col_mappings)
@@ -180,3 +216,741 @@ class AutoloadTest(TestCase):
 
         # finaly check expiration date is correct
         self.assertEqual(GreenAssessmentProperty.objects.get(assessment=self.assessment, _metric=10, date='2017-07-10').expiration_date,datetime.date(2018,7,10))
+
+    # test that a batch of assessments creates new records and updates
+    # existing ones in a single call
+    def test_green_assessment_properties_batch(self):
+        view_1 = self.create_view('123 Test Road', '05401')
+        view_2 = self.create_view('456 Test Road', '05401')
+
+        records = [
+            ({"metric": 5, "date": "2017-07-10", "assessment": self.assessment,
+              "urls": ["http://example.com/1"]},
+             view_1.state.normalized_address, '05401'),
+            ({"metric": 6, "date": "2017-07-10", "assessment": self.assessment},
+             view_2.state.normalized_address, '05401'),
+            ({"metric": 7, "date": "2017-07-19", "assessment": self.assessment,
+              "urls": ["http://example.com/1", "http://example.com/2"]},
+             view_1.state.normalized_address, '05401')]
+
+        resp = self.loader.create_green_assessment_properties(records)
+
+        self.assertEqual([r[0] for r in resp],
+                         [{'created': True, 'updated': False},
+                          {'created': True, 'updated': False},
+                          {'created': False, 'updated': True}])
+        self.assertTrue(GreenAssessmentProperty.objects.filter(view=view_1, _metric=7).exists())
+        self.assertTrue(GreenAssessmentProperty.objects.filter(view=view_2, _metric=6).exists())
+        self.assertEqual(GreenAssessmentURL.objects.filter(property_assessment=resp[2][1]).count(), 2)
+
+    # test that the view index finds views and duplicates without queries
+    def test_view_index(self):
+        view_1 = self.create_view('123 Test Road', '05401')
+        view_2 = self.create_view('123 Test Road', '05401')
+        view_3 = self.create_view('456 Test Road', '05401')
+
+        index = self.loader.load_view_index()
+        with self.assertNumQueries(0):
+            self.assertEqual(index.get(view_3.state.normalized_address, '05401'), (view_3.pk,))
+            self.assertEqual(index.get('789 test rd', '05401'), ())
+            self.assertEqual(list(index.duplicates()),
+                             [((view_1.state.normalized_address, '05401'), (view_1.pk, view_2.pk))])
+
+    # test that green assessment batches report their metrics to the sink
+    def test_green_assessment_metrics(self):
+        view = self.create_view('123 Test Road', '05401')
+        sink = MemorySink()
+        loader = autoload.AutoLoad(self.user, self.org, metrics_sink=sink)
+
+        loader.create_green_assessment_properties([
+            ({"metric": 5, "date": "2017-07-10", "assessment": self.assessment},
+             view.state.normalized_address, '05401')])
+
+        (name, metrics) = sink.records[-1]
+        self.assertEqual(name, 'create_green_assessment_properties')
+        self.assertEqual(metrics['rows'], 1)
+        self.assertEqual(list(metrics['stages']), ['find_views', 'prior_assessments', 'write'])
+        self.assertGreater(metrics['queries'], 0)
+
+    # test that a mapping list is only created once per organization
+    def test_column_mapping_cache(self):
+        col_mappings = [
+            {"from_field": "Address",
+             "to_field": "address_line_1",
+             "to_table_name": "PropertyState"}]
+        import_file = ImportFile.objects.create(import_record=self.dataset, cycle=self.cycle)
+        mapping_cache.clear()
+
+        with mock.patch.object(Column, 'create_mappings', return_value=True) as create_mappings:
+            self.assertEqual(self.loader.save_column_mappings(import_file.pk, col_mappings)['status'], 'success')
+            self.assertEqual(self.loader.save_column_mappings(import_file.pk, col_mappings)['status'], 'success')
+        self.assertEqual(create_mappings.call_count, 1)
+
+    # test that reloading an unchanged assessment doesn't write anything
+    def test_green_assessment_property_unchanged(self):
+        view = self.create_view('123 Test Road', '05401')
+        green_assessment = {"metric": 10,
+                            "date": "2017-07-10",
+                            "assessment": self.assessment}
+
+        (data_log, green_property) = self.loader.create_green_assessment_property(
+            green_assessment, view.state.normalized_address, '05401')
+        self.assertTrue(data_log['created'])
+        logs = GreenAssessmentPropertyAuditLog.objects.filter(greenassessmentproperty=green_property).count()
+
+        (data_log, _) = self.loader.create_green_assessment_property(
+            green_assessment, view.state.normalized_address, '05401')
+        self.assertEqual(data_log, {'created': False, 'updated': False})
+        self.assertEqual(GreenAssessmentPropertyAuditLog.objects.filter(greenassessmentproperty=green_property).count(), logs)
+
+    # test that uploading content that was already loaded returns the
+    # existing import file
+    def test_upload_dedup(self):
+        col_mappings = [
+            {"from_field": "Address",
+             "to_field": "address_line_1",
+             "to_table_name": "PropertyState"}]
+        data = 'Address\n123 Test Road'
+
+        file_id = self.loader.upload('dedup.csv', data, self.dataset, self.cycle,
+                                     dedup=True, col_mappings=col_mappings)
+        # not loaded yet, so the same content is uploaded again
+        self.assertNotEqual(self.loader.upload('dedup.csv', data, self.dataset, self.cycle,
+                                               dedup=True, col_mappings=col_mappings), file_id)
+
+        mark_loaded(file_id, col_mappings)
+        self.assertEqual(self.loader.upload('dedup.csv', data, self.dataset, self.cycle,
+                                            dedup=True, col_mappings=col_mappings), file_id)
+        resp = self.loader.autoload_file(file_id, col_mappings)
+        self.assertTrue(resp['deduplicated'])
+
+    # test that uploads that are never loaded are forgotten
+    def test_upload_dedup_expires(self):
+        with mock.patch('autoload.dedup.cache') as cache:
+            cache.get.return_value = None
+            file_id = self.loader.upload('dedup.csv', 'Address\n123 Test Road', self.dataset,
+                                         self.cycle, dedup=True)
+        cache.set.assert_called_once_with(
+            'autoload:pending:%s' % file_id, mock.ANY, PENDING_TIMEOUT)
+
+    # test that assessments can be referred to by name within a lookup cache
+    def test_lookup_cache(self):
+        view = self.create_view('123 Test Road', '05401')
+
+        with self.loader.lookup_cache() as lookups:
+            self.assertEqual(lookups.assessment('Department of Energy'), self.assessment)
+            self.assertEqual(lookups.assessment(str(self.assessment.pk)), self.assessment)
+            with self.assertNumQueries(0):
+                self.assertEqual(lookups.assessment('Home Energy Score'), self.assessment)
+
+            (data_log, green_property) = self.loader.create_green_assessment_property(
+                {"metric": 10, "date": "2017-07-10", "assessment": 'Home Energy Score'},
+                view.state.normalized_address, '05401')
+        self.assertTrue(data_log['created'])
+        self.assertEqual(green_property.assessment, self.assessment)
+
+    # test that names shared by several assessments aren't resolved
+    def test_lookup_cache_ambiguous(self):
+        GreenAssessment.objects.create(
+                name='Home Energy Score',
+                award_body='Another Body',
+                recognition_type='SCR',
+                description='Another score',
+                is_numeric_score=True,
+                is_integer_score=True,
+                validity_duration=datetime.timedelta(days=365),
+                organization=self.org)
+
+        with self.loader.lookup_cache() as lookups:
+            with self.assertRaisesRegex(KeyError, 'ambiguous'):
+                lookups.assessment('Home Energy Score')
+            self.assertEqual(lookups.assessment('Department of Energy'), self.assessment)
+
+    # test that assessments load from a csv file and bad rows are reported
+    def test_load_green_assessments(self):
+        view = self.create_view('123 Test Road', '05401')
+        data = ('address,postal_code,assessment,metric,date,urls\n'
+                '%s,05401,Home Energy Score,10,2017-07-10,http://example.com/1\n'
+                '%s,05401,Home Energy Score,10,07/10/2017,\n'
+                '999 nowhere road,05401,Home Energy Score,10,2017-07-10,\n') % (
+                    (view.state.normalized_address,) * 2)
+        errors = io.StringIO()
+
+        summary = load_green_assessments(self.loader, io.StringIO(data), errors=errors)
+
+        self.assertEqual(summary['created'], 1)
+        self.assertEqual(summary['rejected'], 2)
+        self.assertTrue(errors.getvalue().startswith('3,date'))
+        self.assertIn('4,no property view', errors.getvalue())
+        self.assertTrue(GreenAssessmentProperty.objects.filter(view=view, _metric=10, date='2017-07-10').exists())
+
+    # test that a file whose header doesn't match the mappings is rejected
+    # before any celery task is started
+    def test_preflight(self):
+        col_mappings = [
+            {"from_field": "Address",
+             "to_field": "address_line_1",
+             "to_table_name": "PropertyState"},
+            {"from_field": "Score",
+             "to_field": "energy_score",
+             "to_table_name": "PropertyState"}]
+
+        file_id = self.loader.upload('preflight.csv', 'Address, Score\n123 Test Road, 100',
+                                     self.dataset, self.cycle)
+        with mock.patch.object(autoload.AutoLoad, 'save_raw_data') as save_raw_data:
+            resp = self.loader.autoload_file(file_id, col_mappings)
+        self.assertEqual(resp['status'], 'error')
+        self.assertEqual(resp['problems'], ["column 'Score' not found, did you mean ' Score'?"])
+        save_raw_data.assert_not_called()
+
+        file_id = self.loader.upload('preflight.csv', 'Address,Score\n123 Test Road,100\n',
+                                     self.dataset, self.cycle)
+        resp = self.loader.preflight(file_id, col_mappings)
+        self.assertEqual(resp['status'], 'success')
+        self.assertEqual(resp['profile']['estimated_rows'], 1)
+        self.assertEqual(resp['profile']['column_types']['Score'], 'integer')
+
+    # test that duplicated addresses are reported and resolved to a view
+    def test_duplicate_resolver(self):
+        view_1 = self.create_view('123 Test Road', '05401')
+        view_2 = self.create_view('123 Test Road', '05401')
+        address = view_1.state.normalized_address
+        green_assessment = {"metric": 5, "date": "2017-07-10", "assessment": self.assessment}
+
+        self.assertIsNone(self.loader.create_green_assessment_property(
+            green_assessment, address, '05401'))
+
+        resolver = self.loader.load_duplicate_resolver(policies=('latest_state',))
+        self.assertEqual(resolver.report(),
+                         [{'normalized_address': address,
+                           'postal_code': '05401',
+                           'view_ids': [view_1.pk, view_2.pk],
+                           'view_id': view_2.pk,
+                           'policy': 'latest_state'}])
+
+        (data_log, green_property) = self.loader.create_green_assessment_property(
+            green_assessment, address, '05401')
+        self.assertTrue(data_log['created'])
+        self.assertEqual(green_property.view_id, view_2.pk)
+
+    # test that only the views in the resolver's cycle are duplicates
+    def test_duplicate_resolver_cycle(self):
+        other_cycle = Cycle.objects.create(
+            organization=self.org,
+            user=self.user,
+            name="other",
+            start=timezone.now(),
+            end=timezone.now())
+        view = self.create_view('123 Test Road', '05401')
+        other_view = self.create_view('123 Test Road', '05401')
+        other_view.cycle = other_cycle
+        other_view.save()
+        views = [self.create_view('456 Test Road', '05401') for _ in range(2)]
+
+        resolver = self.loader.load_duplicate_resolver(
+            policies=('latest_state',), cycle=self.cycle)
+        self.assertEqual([entry['view_ids'] for entry in resolver.report()],
+                         [[views[0].pk, views[1].pk]])
+
+        green_assessment = {"metric": 5, "date": "2017-07-10", "assessment": self.assessment}
+        (_, green_property) = self.loader.create_green_assessment_property(
+            green_assessment, view.state.normalized_address, '05401')
+        self.assertEqual(green_property.view_id, view.pk)
+        (_, green_property) = self.loader.create_green_assessment_property(
+            green_assessment, views[0].state.normalized_address, '05401')
+        self.assertEqual(green_property.view_id, views[1].pk)
+
+    # test that urls differing only trivially are attached once
+    def test_green_assessment_urls(self):
+        view = self.create_view('123 Test Road', '05401')
+        green_assessment = {"metric": 5, "date": "2017-07-10", "assessment": self.assessment,
+                            "urls": [" HTTP://Example.com:80/report#page=2", "http://example.com/report"]}
+
+        (_, green_property) = self.loader.create_green_assessment_property(
+            dict(green_assessment), view.state.normalized_address, '05401')
+        (data_log, _) = self.loader.create_green_assessment_property(
+            dict(green_assessment, urls=["http://EXAMPLE.com/report "]),
+            view.state.normalized_address, '05401')
+
+        self.assertEqual(data_log, {'created': False, 'updated': False})
+        self.assertEqual(list(GreenAssessmentURL.objects.filter(
+            property_assessment=green_property).values_list('url', flat=True)),
+            ['http://example.com/report'])
+
+    # test that uploads to local disk share a directory
+    def test_local_storage(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = LocalStorage(root)
+            names = [storage.write(file_key('local.csv'), [b'Address\n']) for _ in range(3)]
+
+            self.assertEqual(len(set(names)), 3)
+            self.assertEqual(set(os.path.dirname(name) for name in names),
+                             set([os.path.join(root, 'data_imports')]))
+            self.assertEqual(len(os.listdir(os.path.join(root, 'data_imports'))), 3)
+
+    # test that a bounded read of an S3 file only gets the range it needs
+    def test_django_storage_range(self):
+        content = b'Address\n' * 10
+
+        def get(Range):
+            (start, end) = Range[len('bytes='):].split('-')
+            return {'Body': io.BytesIO(content[int(start):int(end) + 1])}
+
+        obj = mock.Mock(content_length=len(content))
+        obj.get.side_effect = get
+        storage = mock.Mock()
+        storage.open.return_value = mock.Mock(obj=obj)
+        backend = DjangoStorage(storage)
+
+        self.assertEqual(backend.open_read('key', 16).read(), content[:16])
+        obj.get.assert_called_once_with(Range='bytes=0-15')
+        storage.open.return_value.read.assert_not_called()
+
+        self.assertEqual(backend.open_read('key', 1000).read(), content)
+        obj.get.assert_called_with(Range='bytes=0-%d' % (len(content) - 1))
+        self.assertIs(backend.open_read('key'), storage.open.return_value)
+
+    # test that uploads can be kept in memory and read back for the preflight
+    def test_memory_storage(self):
+        storage = MemoryStorage()
+        loader = autoload.AutoLoad(self.user, self.org, storage=storage)
+        col_mappings = [
+            {"from_field": "Address",
+             "to_field": "address_line_1",
+             "to_table_name": "PropertyState"}]
+
+        file_id = loader.upload('memory.csv', 'Address\n123 Test Road\n', self.dataset, self.cycle)
+        self.assertEqual(list(storage.files), [ImportFile.objects.get(pk=file_id).file.name])
+        resp = loader.preflight(file_id, col_mappings)
+        self.assertEqual(resp['profile']['estimated_rows'], 1)
+
+    # test that files and iterables of chunks upload the same bytes and
+    # report the bytes written so far after each chunk
+    def test_upload_chunks(self):
+        storage = MemoryStorage()
+        loader = autoload.AutoLoad(self.user, self.org, storage=storage)
+        content = 'Address\n123 Test Road\n'
+
+        def upload(data):
+            written = []
+            file_id = loader.upload('chunks.csv', data, self.dataset, self.cycle,
+                                    progress=written.append)
+            return storage.files[ImportFile.objects.get(pk=file_id).file.name], written
+
+        self.assertEqual(upload(io.StringIO(content)), (content.encode('utf-8'), [22]))
+        self.assertEqual(upload(io.BytesIO(content.encode('utf-8'))),
+                         (content.encode('utf-8'), [22]))
+        self.assertEqual(upload(iter(['Address\n', '', '123 Test Road\n'])),
+                         (content.encode('utf-8'), [8, 22]))
+        self.assertEqual(upload(iter([b'Address\n', b'123 Test Road\n'])),
+                         (content.encode('utf-8'), [8, 22]))
+
+        # files are read CHUNK_SIZE bytes at a time
+        data = b'x' * (2 * CHUNK_SIZE + 10)
+        self.assertEqual(upload(io.BytesIO(data)),
+                         (data, [CHUNK_SIZE, 2 * CHUNK_SIZE, len(data)]))
+
+    # test that files not uploaded with the loader's backend are read from
+    # the import file's storage
+    def test_preflight_other_storage(self):
+        file_id = self.loader.upload('other.csv', 'Address\n123 Test Road\n', self.dataset, self.cycle)
+        loader = autoload.AutoLoad(self.user, self.org, storage=MemoryStorage())
+        col_mappings = [
+            {"from_field": "Address",
+             "to_field": "address_line_1",
+             "to_table_name": "PropertyState"}]
+
+        resp = loader.preflight(file_id, col_mappings)
+        self.assertEqual(resp['status'], 'success')
+        self.assertEqual(resp['profile']['columns'], ['Address'])
+
+    # test that delta uploads only carry new and changed rows
+    def test_upload_delta(self):
+        storage = MemoryStorage()
+        loader = autoload.AutoLoad(self.user, self.org, storage=storage)
+        identity = ['Address', 'Postal Code']
+
+        resp = loader.upload_delta('delta.csv', 'Address,Postal Code,Score\n'
+                                   '123 Test Road,05401,1\n456 Test Road,05401,2\n',
+                                   self.dataset, self.cycle, identity)
+        self.assertEqual((resp['new'], resp['changed'], resp['unchanged']), (2, 0, 0))
+        commit_state(storage, resp['import_file_id'])
+
+        resp = loader.upload_delta('delta.csv', 'Address,Postal Code,Score\n'
+                                   '123 Test Road,05401,3\n789 Test Road,05401,4\n',
+                                   self.dataset, self.cycle, identity)
+        self.assertEqual((resp['new'], resp['changed'], resp['unchanged']), (1, 1, 0))
+        self.assertEqual(resp['deleted'], [{'Address': '456 Test Road', 'Postal Code': '05401'}])
+        name = ImportFile.objects.get(pk=resp['import_file_id']).file.name
+        self.assertEqual(storage.files[name],
+                         b'Address,Postal Code,Score\n123 Test Road,05401,3\n789 Test Road,05401,4\n')
+
+    # test that reloading a batch of unchanged assessments makes the same
+    # number of queries however many records there are
+    def test_green_assessment_query_budget(self):
+        records = []
+        for i in range(10):
+            view = self.create_view('%d Test Road' % i, '05401')
+            records.append(({"metric": 5, "date": "2017-07-10", "assessment": self.assessment},
+                            view.state.normalized_address, '05401'))
+        self.loader.create_green_assessment_properties(records)
+
+        # savepoint, views, prior assessments, their audit logs and release
+        with self.assertQueryBudget(per_batch=5, records=len(records)):
+            resp = self.loader.create_green_assessment_properties(records)
+        self.assertEqual(set(r[0]['updated'] for r in resp), set([False]))
+
+        with self.assertRaisesRegex(AssertionError, r'3 queries for a budget of 1'):
+            with self.assertQueryBudget(per_record=1, records=1):
+                for (_, address, postal_code) in records[:3]:
+                    PropertyView.objects.filter(state__normalized_address=address).first()
+
+        with self.assertRaisesRegex(AssertionError,
+                                    r'3 SELECT seed\.PropertyView \(expected 1, \+2\)'):
+            with self.assertQueryBudget(per_record=3, records=1,
+                                        expected={('seed.PropertyView', 'SELECT'): 1}):
+                for (_, address, postal_code) in records[:3]:
+                    PropertyView.objects.filter(state__normalized_address=address).first()
+
+    # resume a file with every stage but matching stubbed out, returning the
+    # response and the mocks of the stages
+    def resume(self, file_id, col_mappings=None):
+        stages = dict((name, mock.patch.object(autoload.AutoLoad, name))
+                      for name in ('save_raw_data', 'perform_mapping',
+                                   'mapping_done', 'start_system_matching'))
+        mocks = dict((name, patch.start()) for (name, patch) in stages.items())
+        mocks['start_system_matching'].return_value = {
+            'status': 'success', 'progress_key': 'match-key'}
+        try:
+            with mock.patch('autoload.autoload.get_cache',
+                            return_value={'status': 'success', 'progress': 100}):
+                resp = self.loader.resume(file_id, col_mappings)
+        finally:
+            for patch in stages.values():
+                patch.stop()
+        return resp, mocks
+
+    # test that resume continues from the stage in the saved checkpoint
+    def test_resume_from_checkpoint(self):
+        col_mappings = [
+            {"from_field": "Address",
+             "to_field": "address_line_1",
+             "to_table_name": "PropertyState"}]
+        file_id = self.loader.upload('resume.csv', 'Address\n123 Test Road\n',
+                                     self.dataset, self.cycle)
+        Checkpoint(file_id, completed='finish_mapping', col_mappings=col_mappings).save()
+
+        (resp, mocks) = self.resume(file_id)
+        self.assertEqual(resp['status'], 'success')
+        mocks['save_raw_data'].assert_not_called()
+        mocks['perform_mapping'].assert_not_called()
+        mocks['start_system_matching'].assert_called_once_with(file_id)
+        # finished files don't keep a checkpoint
+        self.assertIsNone(Checkpoint.load(file_id).col_mappings)
+
+    # test that resume without a checkpoint goes by the import file's flags
+    def test_resume_from_flags(self):
+        file_id = self.loader.upload('resume.csv', 'Address\n123 Test Road\n',
+                                     self.dataset, self.cycle)
+        ImportFile.objects.filter(pk=file_id).update(raw_save_done=True, mapping_done=True)
+
+        (resp, mocks) = self.resume(file_id)
+        self.assertEqual(resp['status'], 'success')
+        mocks['save_raw_data'].assert_not_called()
+        mocks['mapping_done'].assert_not_called()
+        mocks['start_system_matching'].assert_called_once_with(file_id)
+
+    # test that resume waits on a task that is still running instead of
+    # starting it again
+    def test_resume_in_flight(self):
+        file_id = self.loader.upload('resume.csv', 'Address\n123 Test Road\n',
+                                     self.dataset, self.cycle)
+        Checkpoint(file_id, completed='finish_mapping', running='match_buildings',
+                   progress_key='match-key').save()
+
+        (resp, mocks) = self.resume(file_id)
+        self.assertEqual(resp['status'], 'success')
+        mocks['start_system_matching'].assert_not_called()
+
+    # test that wait_for_task reports a failed task and gives up after the
+    # timeout
+    def test_wait_for_task(self):
+        with mock.patch('autoload.autoload.get_cache',
+                        return_value={'status': 'error', 'message': 'bad row', 'progress': 10}):
+            resp = self.loader.wait_for_task('key')
+        self.assertEqual(resp, {'status': 'error', 'message': 'bad row', 'progress_key': 'key'})
+
+        with mock.patch('autoload.autoload.get_cache',
+                        return_value={'status': 'parsing', 'progress': 50}):
+            resp = self.loader.wait_for_task('key', timeout=0.05)
+        self.assertEqual(resp, {'status': 'error',
+                                'message': 'timed out waiting for task',
+                                'progress_key': 'key'})
+
+    # test that a finished task wakes wait_for_task up without waiting for
+    # the next poll
+    def test_wait_for_task_notified(self):
+        progress = {'status': 'parsing', 'progress': 50}
+
+        def finish():
+            progress.update(status='success', progress=100)
+            task_notifier.notify()
+
+        with mock.patch('autoload.autoload.get_cache', side_effect=lambda key: dict(progress)), \
+                mock.patch('autoload.autoload.poll_delays', return_value=itertools.repeat(60)):
+            threading.Timer(0.05, finish).start()
+            start = time.time()
+            resp = self.loader.wait_for_task('key', timeout=120)
+        self.assertEqual(resp, {'status': 'success', 'progress_key': 'key'})
+        self.assertLess(time.time() - start, 30)
+
+    # test that addresses without a postal code find their view
+    def test_green_assessment_without_postal_code(self):
+        view = self.create_view('123 Test Road', None)
+
+        (data_log, green_property) = self.loader.create_green_assessment_property(
+            {"metric": 5, "date": "2017-07-10", "assessment": self.assessment},
+            view.state.normalized_address, None)
+        self.assertTrue(data_log['created'])
+        self.assertEqual(green_property.view_id, view.pk)
+
+    # test that an address without a view is skipped without failing the
+    # rest of its batch
+    def test_green_assessment_without_view(self):
+        view = self.create_view('123 Test Road', '05401')
+        green_assessment = {"metric": 5, "date": "2017-07-10", "assessment": self.assessment}
+
+        resp = self.loader.create_green_assessment_properties([
+            (green_assessment, view.state.normalized_address, '05401'),
+            (green_assessment, '999 nowhere road', '05401')])
+        self.assertTrue(resp[0][0]['created'])
+        self.assertEqual(resp[1], ({'error': 'no property view'}, None))
+        self.assertEqual(GreenAssessmentProperty.objects.filter(view=view).count(), 1)
+
+
+    # test that the records of a postal code are loaded by a single worker
+    def test_partition(self):
+        records = [({}, '%d test road' % i, '0540%d' % (i % 7)) for i in range(100)]
+
+        parts = partition(records, 16)
+        self.assertTrue(all(parts))
+        self.assertEqual(sorted(itertools.chain(*parts)), sorted(records))
+        for postal_code in set(record[2] for record in records):
+            self.assertEqual(
+                len([part for part in parts if any(r[2] == postal_code for r in part)]), 1)
+
+    # test that a worker counts each batch on its own and that the counts
+    # of the workers add up
+    def test_load_partition(self):
+        views = [self.create_view('%d Test Road' % i, '05401') for i in range(3)]
+        records = [({"metric": 5, "date": "2017-07-10", "assessment": self.assessment.pk},
+                    view.state.normalized_address, '05401') for view in views]
+        # the second batch fails on its unknown assessment
+        records.insert(2, ({"metric": 5, "date": "2017-07-10", "assessment": -1},
+                           views[0].state.normalized_address, '05401'))
+
+        with mock.patch('autoload.autoload.BATCH_SIZE', 2), \
+                mock.patch('autoload.parallel.connections'):
+            first = _load_partition(self.user.pk, self.org.pk, records)
+            second = _load_partition(self.user.pk, self.org.pk, records[:2])
+
+        self.assertEqual(first['created'], 2)
+        self.assertEqual(first['rejected'], 2)
+        self.assertEqual(len(first['errors']), 1)
+        self.assertIn('unknown green assessment', first['errors'][0])
+        self.assertEqual(second['unchanged'], 2)
+
+        summary = merge_summaries([first, second])
+        self.assertEqual(dict(summary, errors=len(summary['errors'])),
+                         {'created': 2, 'updated': 0, 'unchanged': 2, 'duplicates': 0,
+                          'rejected': 2, 'errors': 1})
+
+class AsyncAutoloadTest(TransactionTestCase):
+    # the client's worker threads, like those of AutoLoad.autoload_files,
+    # have database connections of their own, so the fixtures have to be
+    # committed for them to see
+
+    def setUp(self):
+        self.user = User.objects.create(username='async_user@demo.com')
+        self.org = Organization.objects.create()
+        OrganizationUser.objects.create(user=self.user, organization=self.org)
+
+        self.cycle = Cycle.objects.create(
+            organization=self.org,
+            user=self.user,
+            name="test",
+            start=timezone.now(),
+            end=timezone.now())
+
+        self.dataset = ImportRecord.objects.create(
+                name='test',
+                app='seed',
+                start_time=timezone.now(),
+                created_at=timezone.now(),
+                last_modified_by=self.user,
+                super_organization=self.org,
+                owner=self.user)
+
+        self.loader = AsyncAutoLoad(self.user, self.org, max_workers=2)
+
+    def tearDown(self):
+        self.loader.close()
+
+    # test that a file uploaded and loaded from a coroutine is loaded
+    def test_autoload_file(self):
+        col_mappings = [
+            {"from_field": "Address",
+             "to_field": "address_line_1",
+             "to_table_name": "PropertyState"}]
+
+        async def load():
+            file_id = await self.loader.upload(
+                'async.csv', 'Address\n123 Test Road\n', self.dataset, self.cycle)
+            return await self.loader.autoload_file(file_id, col_mappings)
+
+        resp = asyncio.run(load())
+        self.assertEqual(resp['status'], 'success')
+        self.assertTrue(PropertyState.objects.filter(
+            import_file_id=resp['import_file_id'], address_line_1='123 Test Road').exists())
+
+    # test that several files are loaded at once, with their responses in
+    # order and matching one file of the cycle at a time
+    def test_autoload_files(self):
+        loader = self.loader.loader
+        col_mappings = [
+            {"from_field": "Address",
+             "to_field": "address_line_1",
+             "to_table_name": "PropertyState"}]
+        file_ids = [loader.upload('files.csv', 'Address\n%d Test Road\n' % i,
+                                  self.dataset, self.cycle) for i in range(4)]
+        task = {'status': 'success', 'progress_key': 'task-key'}
+
+        matching = []
+        overlaps = []
+        matching_lock = threading.Lock()
+
+        def start_system_matching(file_id):
+            with matching_lock:
+                overlaps.append(bool(matching))
+                matching.append(file_id)
+            time.sleep(0.05)
+            with matching_lock:
+                matching.remove(file_id)
+            return task
+
+        jobs = [(file_id, col_mappings) for file_id in file_ids]
+        # a file that doesn't exist fails on its own
+        jobs.insert(2, (-1, col_mappings))
+        with mock.patch.object(autoload.AutoLoad, 'save_raw_data', return_value=task), \
+                mock.patch.object(autoload.AutoLoad, 'perform_mapping', return_value=task), \
+                mock.patch.object(autoload.AutoLoad, 'mapping_done'), \
+                mock.patch.object(autoload.AutoLoad, 'start_system_matching',
+                                  side_effect=start_system_matching), \
+                mock.patch('autoload.autoload.get_cache',
+                           return_value={'status': 'success', 'progress': 100}):
+            resps = loader.autoload_files(jobs, max_concurrency=4)
+
+        self.assertEqual([resp['import_file_id'] for resp in resps],
+                         [job[0] for job in jobs])
+        self.assertEqual([resp['status'] for resp in resps],
+                         ['success', 'success', 'error', 'success', 'success'])
+        self.assertTrue(all(resp['elapsed'] >= 0 for resp in resps))
+        self.assertEqual(overlaps, [False] * 4)
+
+    # test that waiting on a task from a coroutine reports errors and
+    # timeouts
+    def test_wait_for_task(self):
+        with mock.patch('autoload.aio.get_cache',
+                        return_value={'status': 'error', 'message': 'bad row', 'progress': 10}):
+            resp = asyncio.run(self.loader.wait_for_task('key'))
+        self.assertEqual(resp, {'status': 'error', 'message': 'bad row', 'progress_key': 'key'})
+
+        with mock.patch('autoload.aio.get_cache',
+                        return_value={'status': 'parsing', 'progress': 50}):
+            resp = asyncio.run(self.loader.wait_for_task('key', timeout=0.05))
+        self.assertEqual(resp['message'], 'timed out waiting for task')
+
+    # start loading a file with every stage but matching stubbed out and
+    # cancel it once until_cancelled(lock, load, mapped) returns, with lock
+    # the match lock of the file and mapped an event set once mapping is
+    # done. Returns the match lock.
+    def cancel_autoload_file(self, until_cancelled, get_cache):
+        mapped = threading.Event()
+        col_mappings = [
+            {"from_field": "Address",
+             "to_field": "address_line_1",
+             "to_table_name": "PropertyState"}]
+        task = {'status': 'success', 'progress_key': 'task-key'}
+
+        async def load():
+            file_id = await self.loader.upload(
+                'cancel.csv', 'Address\n123 Test Road\n', self.dataset, self.cycle)
+            lock = await self.loader._call(self.loader.loader._match_lock, file_id)
+            load = asyncio.ensure_future(self.loader.autoload_file(file_id, col_mappings))
+            await until_cancelled(lock, load, mapped)
+            load.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await load
+            return lock
+
+        with mock.patch.object(autoload.AutoLoad, 'save_raw_data', return_value=task), \
+                mock.patch.object(autoload.AutoLoad, 'perform_mapping', return_value=task), \
+                mock.patch.object(autoload.AutoLoad, 'mapping_done',
+                                  side_effect=lambda file_id: mapped.set()), \
+                mock.patch.object(autoload.AutoLoad, 'start_system_matching',
+                                  return_value={'status': 'success', 'progress_key': 'match-key'}), \
+                mock.patch('autoload.aio.get_cache', side_effect=get_cache):
+            return asyncio.run(load())
+
+    async def wait_until(self, condition, load):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertFalse(load.done())
+            self.assertLess(time.time(), deadline)
+            await asyncio.sleep(0.01)
+
+    # the pipeline is closed on a worker thread after the cancellation
+    def assertReleased(self, lock):
+        deadline = time.time() + 5
+        while not lock.acquire(blocking=False):
+            self.assertLess(time.time(), deadline, 'match lock not released')
+            time.sleep(0.01)
+        lock.release()
+
+    # test that cancelling once the match lock is taken, while the step
+    # that starts matching is still queued in the executor, releases the lock
+    def test_cancel_in_executor(self):
+        finish = threading.Event()
+
+        async def until_cancelled(lock, load, mapped):
+            # keep every worker busy while the pipeline waits for the lock,
+            # so that the step after it can't start
+            lock.acquire()
+            await self.wait_until(mapped.is_set, load)
+            for _ in range(2):
+                self.loader.executor.submit(finish.wait, 5)
+            lock.release()
+            await self.wait_until(lock.locked, load)
+
+        lock = self.cancel_autoload_file(
+            until_cancelled, lambda key: {'status': 'success', 'progress': 100})
+        finish.set()
+        self.assertReleased(lock)
+
+    # test that cancelling while waiting on the matching task releases the
+    # match lock
+    def test_cancel_holding_lock(self):
+        matching = threading.Event()
+
+        def get_cache(key):
+            if key != 'match-key':
+                return {'status': 'success', 'progress': 100}
+            matching.set()
+            return {'status': 'matching', 'progress': 50}
+
+        async def until_cancelled(lock, load, mapped):
+            await self.wait_until(matching.is_set, load)
+            self.assertTrue(lock.locked())
+
+        lock = self.cancel_autoload_file(until_cancelled, get_cache)
+        self.assertReleased(lock)